@@ -2,17 +2,320 @@
 This file contains all the things needed to manage a single character
 """
 import math
+import sys
+from charstore import CharStore
+from coldcache import ColdMiss
 from datetime import datetime
 from devmsg import devmsg
+from functools import lru_cache
+
+# Database columns of the characters table
+COLUMNS = frozenset((
+    'password',      'is_admin',      'level',         'next_ttl',      'nick',          'userhost',
+    'online',        'idled',         'x_pos',         'y_pos',         'pen_msg',       'pen_nick',
+    'pen_part',      'pen_kick',      'pen_quit',      'pen_quest',     'pen_logout',    'created',
+    'lastlogin',     'amulet',        'charm',         'helm',          'boots',         'gloves',
+    'ring',          'legs',          'shield',        'tunic',         'weapon',        'powerpots',
+    'luckpots',      'alignment',     'gold',          'ffight',        'bwon',          'blost',
+    'badd',          'bminus',        'rname',         'avatar',        'sex',           'age',
+    'location',      'email',         'regentm',       'challengetime', 'hero',          'hlevel',
+    'engineer',      'englevel',      'slaytime',      'bet',           'pot',           'network',
+    'bank',          'team',          'luckload',      'powerload',     'id',            'username',
+    'charclass',
+))
+
+# Item slots every character has
+ITEMS = ('ring', 'amulet', 'charm', 'weapon', 'helm', 'tunic', 'gloves', 'legs', 'shield', 'boots')
+
+# Columns kept in the CharStore, set through properties
+STORE_COLUMNS = frozenset(('level', 'next_ttl', 'online', 'idled', 'x_pos', 'y_pos', 'alignment'))
+
+# Columns of type TEXT. Anything else is INTEGER.
+TEXT_COLUMNS = frozenset(ITEMS + (
+    'username', 'password', 'charclass', 'nick', 'userhost', 'alignment', 'avatar',
+    'sex', 'age', 'location', 'email', 'network', 'rname',
+))
+
+# Text columns with few distinct values, like 'not set'. Every character shares one copy of each value.
+INTERNED_COLUMNS = frozenset(ITEMS + (
+    'charclass', 'avatar', 'sex', 'age', 'location', 'email', 'network', 'rname',
+))
+
+# Columns hardly anything reads. With a ColdCache they're only fetched from the database when used.
+COLD_COLUMNS = frozenset(('password', 'email', 'avatar', 'location', 'age', 'rname', 'userhost', 'created'))
+
+_MISSING = object()
+
+
+def to_text(val):
+    """
+    :param val: column value
+    :return: the value as a string, or None
+    """
+    return None if val is None else str(val)
+
+
+def to_interned(val):
+    """
+    :param val: column value
+    :return: the value as the shared copy of its string, or None
+    """
+    return None if val is None else sys.intern(str(val))
+
+
+def to_integer(val):
+    """
+    :param val: column value
+    :return: the value as an int if it's a string of digits, otherwise unchanged, like SQLite does
+    """
+    if isinstance(val, str) and val.lstrip('-').isdigit():
+        return int(val)
+    return val
+
+
+# Dict of column name to the function that gives its values their proper type. Store columns do their own.
+CONVERTERS = {
+    col: to_interned if col in INTERNED_COLUMNS else to_text if col in TEXT_COLUMNS else to_integer
+    for col in COLUMNS - STORE_COLUMNS
+}
+
+
+@lru_cache(maxsize=4096)
+def parse_item(item: str) -> tuple:
+    """
+    Split prefix, level, and suffix from raw item string
+    :param item: string, item description like '5' or 'a5' or '5a' or 'a5a'
+    :return: tuple of 1 char, 1 integer, 1 char
+    """
+    prefix = ''
+    level = ''
+    suffix = ''
+    digits = '0123456789'
+    alphas = 'abcdefghijklmnopqrstuvwxyz'
+    stage = 0  # 0: prefix, 1: level, 2: suffix
+    for x in item:
+        if stage == 0 and x in alphas:
+            prefix = x
+            stage = 1
+            continue
+        elif stage == 0 and x in digits:
+            level += x
+            stage = 1
+            continue
+        elif stage == 1 and x in digits:
+            level += x
+            continue
+        elif stage == 1 and x in alphas:
+            suffix = x
+            stage = 2
+    return prefix, int(level) if level else 0, suffix
+
+
+def hot_column(name: str):
+    """
+    Make a property that keeps a column in the character's CharStore row
+    :param name: column name, same as the CharStore array name
+    :return: property
+    """
+    def getter(self):
+        return int(getattr(self._store, name)[self._row])
+
+    def setter(self, val):
+        getattr(self._store, name)[self._row] = val
+
+    return property(getter, setter)
+
+
+def cold_column(name: str):
+    """
+    Make a property that keeps a column in the character's ColdCache entry, or its own dict without one
+    :param name: column name
+    :return: property
+    """
+    def getter(self):
+        cold = self._cold
+        values = self._cold_values if cold is None else cold.get(self.id)
+        if name not in values and cold is not None and self.id in cold.loading:
+            raise ColdMiss(f"{name} of {self.id} read before it was fetched, use hydrated() first")
+        return values.get(name)
+
+    def setter(self, val):
+        cold = self._cold
+        values = self._cold_values if cold is None else cold.get(self.id)
+        values[name] = val
+
+    return property(getter, setter)
 
 
 class Character:
-    def __init__(self, char_data):
+    # Every column not in the CharStore or ColdCache gets a slot, so there's no per-character __dict__
+    __slots__ = tuple(sorted(COLUMNS - STORE_COLUMNS - COLD_COLUMNS)) + (
+        '_store', '_row', '_cold', '_cold_values',
+        '_on_change', '_changed', '_new', '_items', '_item_sum', '_aligned_sum',
+        # Not saved, only here because the level-up code sets them
+        'popcorn', 'regentime', 'bets',
+    )
+
+    # Columns that live in the ColdCache rather than on the object
+    password = cold_column('password')
+    email = cold_column('email')
+    avatar = cold_column('avatar')
+    location = cold_column('location')
+    age = cold_column('age')
+    rname = cold_column('rname')
+    userhost = cold_column('userhost')
+    created = cold_column('created')
+
+    # Columns that live in the CharStore rather than on the object
+    level = hot_column('level')
+    x_pos = hot_column('x_pos')
+    y_pos = hot_column('y_pos')
+
+    @property
+    def next_ttl(self):
+        return self._store.get_next_ttl(self._row)
+
+    @next_ttl.setter
+    def next_ttl(self, val):
+        self._store.set_next_ttl(self._row, val)
+
+    @property
+    def idled(self):
+        return self._store.get_idled(self._row)
+
+    @idled.setter
+    def idled(self, val):
+        self._store.set_idled(self._row, val)
+
+    @property
+    def online(self):
+        return int(self._store.online[self._row])
+
+    @online.setter
+    def online(self, val):
+        self._store.set_online(self._row, val)
+
+    @property
+    def alignment(self):
+        return CharStore.ALIGNMENTS[self._store.align[self._row]]
+
+    @alignment.setter
+    def alignment(self, val):
+        self._store.align[self._row] = CharStore.ALIGN_CODES[val]
+        self._aligned_sum = None
+
+    def __init__(self, char_data, on_change=None, new=False, store=None, row=None, cold=None):
+        """
+        :param char_data: Dict of character key/values
+        :param on_change: Optional callable, given this character and the column name whenever a column changes
+        :param new: True if this character isn't in the database yet
+        :param store: CharStore holding this character's per-tick fields. A private one is made if None.
+        :param row: This character's row in store
+        :param cold: ColdCache to keep the cold columns in. They're kept on the character if None.
+        """
+        if store is None:
+            store = CharStore(1)
+            row = store.add(char_data['id'])
+        self._store = store
+        self._row = row
+        self._cold = cold
+        self._cold_values = None  # Dict of cold columns, when there's no ColdCache
+        self._on_change = None
+        self._changed = None  # Set of columns changed since the last save, None until something changes
+        self._new = new
+        self._items = None        # Dict of item slot to parsed (prefix, level, suffix), built on first use
+        self._item_sum = None     # Sum of item levels, built on first use
+        self._aligned_sum = None  # Sum of item levels adjusted for alignment, built on first use
+        # Nothing to track while loading, so plain columns go straight into their slots
+        cold_values = {}
         for key, val in char_data.items():
             # devmsg(f"setting '{key}' to '{val}'")
-            setattr(self, key, val)
+            if key in STORE_COLUMNS:
+                setattr(self, key, val)
+                continue
+            convert = CONVERTERS.get(key)
+            if convert is None:
+                devmsg(f"ignoring unknown column '{key}'")
+            elif key in COLD_COLUMNS:
+                cold_values[key] = convert(val)
+            else:
+                object.__setattr__(self, key, convert(val))
+        # Without cold columns, they're left in the database until something wants them
+        if cold is None:
+            self._cold_values = cold_values
+        elif cold_values:
+            cold.put(self.id, cold_values, pin=new)
+        # Only start reporting changes once we're fully loaded
+        self._changed = None
+        self._on_change = on_change
         # devmsg(f"char {vars(self)}")
 
+    def __setattr__(self, key, val):
+        """
+        Set an attribute, and remember which database columns need saving
+        """
+        if key not in COLUMNS:
+            object.__setattr__(self, key, val)
+            return
+        convert = CONVERTERS.get(key)
+        if convert is not None:
+            val = convert(val)
+        try:
+            old = getattr(self, key, _MISSING)
+        except ColdMiss:
+            old = _MISSING  # Set before it was fetched; the fetched value won't overwrite it
+        if old == val:
+            return
+        object.__setattr__(self, key, val)
+        changed = self._changed
+        if changed is None:
+            self._changed = changed = set()
+        changed.add(key)
+        on_change = self._on_change
+        if on_change is not None:
+            on_change(self, key)
+
+    def detach(self, store=None, row=None) -> None:
+        """
+        Move this character's store columns into another CharStore and stop reporting changes.
+        For characters dropped from memory, so anything still holding them can't touch whoever gets their row.
+        :param store: CharStore to move to, shared by everyone detached together. A private one is made if None.
+        :param row: row in store to move to, already add()ed
+        :return: None
+        """
+        old = self._store
+        old_row = self._row
+        if store is None:
+            store = CharStore(1)
+            row = store.add(self.id)
+        for name in store.columns():
+            getattr(store, name)[row] = getattr(old, name)[old_row]
+        store.clock = old.clock
+        self._on_change = None
+        self._store = store
+        self._row = row
+
+    def pop_changes(self) -> tuple:
+        """
+        Get the columns changed since the last call, and start tracking afresh
+        :return: sorted tuple of column names
+        """
+        if not self._changed:
+            return ()
+        changed = tuple(sorted(self._changed))
+        self._changed = None
+        return changed
+
+    def keep_changes(self, columns) -> None:
+        """
+        Put columns back to be saved again, after writing them failed
+        :param columns: iterable of column names
+        :return: None
+        """
+        if self._changed is None:
+            self._changed = set()
+        self._changed.update(columns)
+
     def whoami(self):
         """
         Create a one-line description of the character
@@ -60,19 +363,39 @@ class Character:
 
     def itemsum(self, align=False):
         """
-        Return character's sum of items
-        TODO: strip special item codes when implemented
+        Return character's sum of items, cached until set_item() changes one
         :param align: Whether to consider alignment
         :return: int
         """
-        item_sum = int(self.ring) + int(self.amulet) + int(self.charm) + int(self.weapon) + int(self.helm)
-        item_sum += int(self.tunic) + int(self.gloves) + int(self.legs) + int(self.shield) + int(self.boots)
         if align:
-            if self.alignment == 'e':
-                item_sum = int(item_sum * 0.9)
-            if self.alignment == 'g':
-                item_sum = int(item_sum * 1.1)
-        return item_sum
+            if self._aligned_sum is None:
+                item_sum = self.itemsum()
+                if self.alignment == 'e':
+                    item_sum = int(item_sum * 0.9)
+                if self.alignment == 'g':
+                    item_sum = int(item_sum * 1.1)
+                self._aligned_sum = item_sum
+            return self._aligned_sum
+        if self._item_sum is None:
+            self._item_sum = sum(level for prefix, level, suffix in self.parsed_items().values())
+        return self._item_sum
+
+    def parsed_items(self) -> dict:
+        """
+        Get every item split into its parts, parsing them only once
+        :return: dict of item slot to (prefix, level, suffix)
+        """
+        if self._items is None:
+            self._items = {slot: parse_item(str(getattr(self, slot))) for slot in ITEMS}
+        return self._items
+
+    def item_level(self, item_type: str) -> int:
+        """
+        Get just the level of one of the character's items
+        :param item_type: the item type, amulet, shield...
+        :return: integer level
+        """
+        return self.parsed_items()[item_type][1]
 
     def heshe(self, uppercase: bool = 0):
         if self.sex == 'male':
@@ -174,14 +497,17 @@ class Character:
         """
         return getattr(self, item_type)
 
-    def set_item(self, item_type: str, item_level: str) -> str:
+    def set_item(self, item_type: str, item_level: str) -> None:
         """
-        Get the level of a character's item
+        Set a character's item. Always change items through here, so the cached sums stay right.
         :param item_type: the item type, amulet, shield...
         :param item_level: the string description of the level (a2b, 12, etc.)
-        :return: string representing the item value
+        :return: None
         """
-        return setattr(self, item_type, item_level)
+        self._items = None
+        self._item_sum = None
+        self._aligned_sum = None
+        setattr(self, item_type, str(item_level))
 
     @staticmethod
     def duration(seconds):
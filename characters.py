@@ -1,37 +1,138 @@
 """
 This file contains all the necessary bits to manage list of game characters
 """
+import asyncio
 import character
+import charstore
+import coldcache
 import math
+import ranking
+import scheduler
 import time
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 from devmsg import devmsg
-from operator import attrgetter
+from indexedset import IndexedSet
 
 
 class Characters:
     """
     The Character object manager
     """
-    def __init__(self, dbh):
+    def __init__(self, db, write_behind: bool = True, snapshot=None, cold_cache: int = 1000, resident: int = None):
+        """
+        :param db: database.Database to load from and write to
+        :param write_behind: Queue changed characters for flush() instead of committing on every update()
+        :param snapshot: Optional snapshot.Snapshot to load from when it's current, and save at checkpoints
+        :param cold_cache: Most characters to keep the cold columns of in memory
+        :param resident: Most offline characters to keep in memory, the rest are loaded when needed. None for all.
+        """
         self.chars = {}  # Dict of char names to Character objects
-        self.dbh = dbh
+        self.store = charstore.CharStore()  # Per-tick fields of every character, as columns
+        self.db = db
+        self.snapshot = snapshot
+        self.schema = {}  # Dict of column name to declared type, cold columns aside, filled in by load()
+        self.cold = coldcache.ColdCache(db, sorted(character.COLD_COLUMNS), cold_cache)
+        self.write_behind = write_behind
+        self.resident = resident
+        self.offline = OrderedDict()  # IDs of offline characters in memory, least recently used first
+        self.total = 0  # Number of characters, in memory or not
+        self.dirty = set()  # IDs of characters changed since the last flush()
+        self.writing = {}   # Dict of character id to the number of queued writes of their values
+        self.finished = deque()  # Writes that finished with no event loop to hear about it, for flush()
+        self.update_queries = {}  # Tuple of column names to the update query for them
+        self.rereads = None  # IDs changed while checkpoint() reads them, None when it isn't
+        # Online indexes, kept up to date as characters change
+        self.online_ids = IndexedSet()
+        self.online_by_alignment = {align: IndexedSet() for align in charstore.CharStore.ALIGNMENTS}
+        self.online_by_level = {}  # Dict of level to set of online IDs at that level
+        self.online_by_sum = []    # Sorted list of (item sum, id) of online characters
+        self.indexed = {}          # Dict of online ID to the (alignment, level, item sum) it is indexed under
+        self.ranking = ranking.Ranking(self.chars, self.store, db, resident=resident is not None)
 
-    def add(self, char_data):
+    def add(self, char_data, new=False):
         """
         Add a character to the list of known characters based on the character data
         :param char_data: Dict of character key/values
+        :param new: True if the character isn't in the database yet
         :return: Character object
         """
         username = char_data["username"]
         char_id = char_data["id"]
         if username in self.chars:
             raise Exception(f"Character '{username}' already exists!")
-        char = character.Character(char_data)
+        row = self.store.add(char_id)
+        char = character.Character(
+            char_data, on_change=self.changed, new=new, store=self.store, row=row, cold=self.cold
+        )
         self.chars[char_id] = char
+        if self.rereads is not None:
+            self.rereads.add(char_id)
+        if new:
+            self.dirty.add(char_id)
+            self.total += 1
+        if not char.online:
+            self.offline[char_id] = None
+        self.reindex(char)
+        self.ranking.add(char)
         return char
 
-    def find(self, member=None, player_id=None):
+    def changed(self, char, key: str) -> None:
+        """
+        Called by a character when one of its columns changes.
+        Note that it needs saving on the next flush(), and keep the online indexes current.
+        :param char: Character object
+        :param key: column name
+        :return: None
+        """
+        self.dirty.add(char.id)
+        if self.rereads is not None:
+            self.rereads.add(char.id)
+        if key in character.COLD_COLUMNS:
+            self.cold.pin(char.id)
+        if key == 'online':
+            if char.online:
+                self.offline.pop(char.id, None)
+                # Keeps the resident set in load() the most recently seen, not just the newest
+                char.lastlogin = int(time.time())
+            else:
+                self.offline[char.id] = None
+        if key == 'online' or key == 'alignment' or key == 'level' or key in character.ITEMS:
+            self.reindex(char)
+        self.ranking.changed(char, key)
+
+    def reindex(self, char) -> None:
         """
+        Move a character to the right online indexes for its online, alignment, level and item sum
+        :param char: Character object
+        :return: None
+        """
+        char_id = char.id
+        old = self.indexed.pop(char_id, None)
+        if old is not None:
+            old_align, old_level, old_sum = old
+            del self.online_by_sum[bisect_left(self.online_by_sum, (old_sum, char_id))]
+            self.online_ids.discard(char_id)
+            self.online_by_alignment[old_align].discard(char_id)
+            bucket = self.online_by_level[old_level]
+            bucket.discard(char_id)
+            if not bucket:
+                del self.online_by_level[old_level]
+        if char.online != 1:
+            return
+        align = char.alignment
+        level = char.level
+        item_sum = char.itemsum()
+        self.indexed[char_id] = (align, level, item_sum)
+        insort(self.online_by_sum, (item_sum, char_id))
+        self.online_ids.add(char_id)
+        self.online_by_alignment[align].add(char_id)
+        self.online_by_level.setdefault(level, set()).add(char_id)
+
+    async def find(self, member=None, player_id=None):
+        """
+        Characters that aren't in memory are loaded from the database without holding up the event loop
         :param member: Discord member object
         :param player_id: player's id (same as Discord member id)
         :return: character object (existing, or new if it didn't exist)
@@ -42,7 +143,15 @@ class Characters:
         if player_id is None:
             player_id = member.id
         if player_id in self.chars:
+            if player_id in self.offline:
+                self.offline.move_to_end(player_id)
             return self.chars[player_id]
+        if self.resident is not None:
+            char = await self.rehydrate(player_id)
+            if char is not None:
+                return char
+            if player_id in self.chars:
+                return self.chars[player_id]  # Made by someone else while we waited
         # They don't exist, so we'll just add them right in, possibly against their will
         name = member.global_name
         if name is None:
@@ -112,93 +221,526 @@ class Characters:
             'team': None,
             'rname': 'not set'
         }
-        char = self.add(chardict)
-        self.update(player_id)
+        char = self.add(chardict, new=True)
+        self.update(char)
         return char
 
+    async def rehydrate(self, player_id: int):
+        """
+        Load a character that isn't in memory back from the database
+        :param player_id: player's id
+        :return: Character object, or None if they're not in the database either
+        """
+        cols, rows = await self.db.read(
+            f"select {', '.join(self.schema)} from characters where id = ?", (player_id,)
+        )
+        if player_id in self.chars:
+            return self.chars[player_id]  # Loaded by someone else while we waited
+        if not rows:
+            return None
+        chardict = dict(zip(cols, rows[0]))
+        chardict['online'] = 0
+        return self.add(chardict)
+
+    async def preload(self, char_ids, keep=None) -> set:
+        """
+        Load characters that aren't in memory from the database in bulk, rather than one
+        rehydrate() each. Only does anything in resident mode.
+        :param char_ids: iterable of character ids
+        :param keep: set of the ids to actually load, the rest are only checked for; None loads them all
+        :return: set of the ids found in the database
+        """
+        found = set()
+        if self.resident is None:
+            return found
+        wanted = [char_id for char_id in char_ids if char_id not in self.chars]
+        query = f"select {', '.join(self.schema)} from characters where id in"
+        for start in range(0, len(wanted), self.cold.batch):
+            batch = wanted[start:start + self.cold.batch]
+            cols, rows = await self.db.read(f"{query} ({', '.join('?' * len(batch))})", tuple(batch))
+            for row in rows:
+                chardict = dict(zip(cols, row))
+                char_id = chardict['id']
+                found.add(char_id)
+                if char_id in self.chars:
+                    continue  # Loaded by someone else while we waited
+                if keep is None or char_id in keep:
+                    chardict['online'] = 0
+                    self.add(chardict)
+        return found
+
+    @contextmanager
+    def batch(self):
+        """
+        Hold every update made inside the with block for one write at the end.
+        In write-behind mode they're held for the next flush() as usual.
+        :return: context manager
+        """
+        if self.write_behind:
+            yield
+            return
+        self.write_behind = True
+        try:
+            yield
+        finally:
+            self.write_behind = False
+            self.flush()
+
+    async def reconcile(self, members) -> int:
+        """
+        Bring characters in line with their members' status after connecting:
+        make any missing characters, set who is online, and write it all in one transaction.
+        :param members: list of Discord member objects
+        :return: count of characters whose online status changed
+        """
+        # Load the online members in bulk. Offline ones just need to be known to exist.
+        online_ids = {m.id for m in members if m.raw_status != 'offline'}
+        known = await self.preload([m.id for m in members], keep=online_ids)
+        changed = 0
+        with self.batch():
+            for member in members:
+                online = 0 if member.raw_status == 'offline' else 1
+                if not online and member.id in known and member.id not in self.chars:
+                    continue  # Offline, and load() already marked everyone offline in the database
+                char = await self.find(member)
+                if char.online != online:
+                    char.online = online
+                    changed += 1
+        self.flush()
+        return changed
+
+    def evict(self) -> int:
+        """
+        Drop the least recently used offline characters from memory, past the resident limit.
+        Only characters with nothing left to write are dropped, so call this after flush().
+        :return: count of characters dropped
+        """
+        if self.resident is None:
+            return 0
+        kept = []
+        dropped = []
+        while len(self.offline) > self.resident:
+            char_id, _ = self.offline.popitem(last=False)
+            char = self.chars[char_id]
+            if char_id in self.dirty or char._new or char_id in self.cold.pinned or char_id in self.writing:
+                kept.append(char_id)
+                continue
+            del self.chars[char_id]
+            self.ranking.remove(char)
+            if self.rereads is not None:
+                self.rereads.add(char_id)
+            dropped.append(char)
+        for char_id in kept:
+            self.offline[char_id] = None
+            self.offline.move_to_end(char_id, last=False)
+        if dropped:
+            # Copy the rows out before clearing them, for anything still holding the characters
+            scratch = self.scratch(len(dropped))
+            for char in dropped:
+                row = char._row
+                char.detach(scratch, scratch.add(char.id))
+                self.store.remove(row)
+        return len(dropped)
+
+    def scratch(self, size: int):
+        """
+        Make a CharStore for characters that aren't kept, so a batch of them shares one
+        instead of each making their own
+        :param size: number of characters it will hold
+        :return: CharStore
+        """
+        store = charstore.CharStore(max(size, 1))
+        store.clock = self.store.clock
+        return store
+
+    async def fetch(self, char_ids: list) -> list:
+        """
+        Get characters by id, loading any that aren't in memory from the database.
+        Those are only lent out for display, they aren't kept.
+        :param char_ids: list of character ids
+        :return: list of Character objects, in the same order, leaving out any that don't exist
+        """
+        missing = [char_id for char_id in char_ids if char_id not in self.chars]
+        loaded = {}
+        for start in range(0, len(missing), self.cold.batch):
+            batch = missing[start:start + self.cold.batch]
+            cols, rows = await self.db.read(
+                f"select {', '.join(self.schema)} from characters where id in ({', '.join('?' * len(batch))})",
+                tuple(batch)
+            )
+            scratch = self.scratch(len(rows))
+            for row in rows:
+                chardict = dict(zip(cols, row))
+                char = character.Character(
+                    chardict, cold=self.cold, store=scratch, row=scratch.add(chardict['id'])
+                )
+                loaded[char.id] = char
+        chars = self.chars
+        return [
+            chars[char_id] if char_id in chars else loaded[char_id]
+            for char_id in char_ids if char_id in chars or char_id in loaded
+        ]
+
     def load(self):
         """
-        Load all the characters from the database.  Set their online to 0.
+        Load all the characters, from the snapshot if it's current, otherwise from the database.
+        Cold columns are left in the database until they're used. When there's a resident limit,
+        only the most recently seen characters are loaded. Everyone is set offline, in the database too.
         If a character is found as not offline when we join, we'll toggle it.
         :return: None
         """
         devmsg('loading...')
-        cursor = self.dbh.cursor()
-        rows = cursor.execute("select * from characters")
-        cols = [x[0] for x in cursor.description]
-        colcount = len(cols)
+        self.load_schema()
+        self.total = self.db.query("select count(*) from characters").result()[1][0][0]
+        columns = None
+        if self.snapshot is not None:
+            columns = self.snapshot.load(self.db.query("pragma user_version").result()[1][0][0])
+        # Everyone in the database is offline too, until reconcile() finds them online, including
+        # those left out of memory. Queued after the snapshot's generation check, which this write moves on from.
+        self.db.submit([("update characters set online = 0 where online != 0", [()])])
+        if columns is not None:
+            cols = list(columns)
+            rows = zip(*columns.values())
+            devmsg('from snapshot...')
+        else:
+            query = f"select {', '.join(self.schema)} from characters"
+            if self.resident is not None:
+                query += f" order by cast(lastlogin as integer) desc limit {int(self.resident)}"
+            cols, rows = self.db.query(query).result()
         for row in rows:
-            chardict = {}
-            for index in range(0, colcount):
-                # devmsg(f"{cols[index]}: {row[index]}")
-                chardict[cols[index]] = row[index]
+            chardict = dict(zip(cols, row))
             chardict['online'] = 0
             char = self.add(chardict)
             # devmsg(f"char: {char}")
-        cursor.close()
         devmsg('loaded.')
 
+    def load_schema(self) -> None:
+        """
+        Find out the columns of the characters table, other than the cold ones, and their declared types
+        :return: None
+        """
+        cols, rows = self.db.query("pragma table_info(characters)").result()
+        self.schema = {row[1]: row[2].upper() for row in rows if row[1] not in character.COLD_COLUMNS}
+
+    async def checkpoint(self, chunk: int = 1000):
+        """
+        Write out every change, then save a snapshot to load from next time.
+        Characters are read chunk at a time so the event loop keeps running; anyone changed meanwhile
+        is read again at the end, along with the per-tick columns, right before the last flush().
+        Waits for the database to catch up first, if it's busy.
+        :param chunk: characters to read between yields
+        :return: Future that resolves once the snapshot is saved, or None if there's no snapshot
+        """
+        await self.db.caught_up()
+        if self.snapshot is None:
+            self.flush()
+            return None
+        if not self.schema:
+            self.load_schema()
+        schema = {name: kind for name, kind in self.schema.items() if name not in character.STORE_COLUMNS}
+        chars = list(self.chars.values())
+        columns = {name: [] for name in schema}
+        rows = []
+        positions = {}
+        self.rereads = set()
+        try:
+            async for start in scheduler.cooperative(range(0, len(chars), chunk), 1):
+                part = chars[start:start + chunk]
+                for name, values in self.snapshot.columns(part, schema).items():
+                    columns[name].extend(values)
+                rows.extend(char._row for char in part)
+                positions.update((char.id, n) for n, char in enumerate(part, start))
+            await self.db.caught_up()
+        finally:
+            rereads, self.rereads = self.rereads, None
+        # Anyone changed, added or evicted meanwhile is read again as they are now
+        again = [self.chars[char_id] for char_id in rereads if char_id in self.chars]
+        gone = [positions[char_id] for char_id in rereads if char_id not in self.chars and char_id in positions]
+        for char, values in zip(again, zip(*self.snapshot.columns(again, schema).values())):
+            n = positions.get(char.id)
+            if n is None:
+                chars.append(char)
+                rows.append(char._row)
+                for name, val in zip(schema, values):
+                    columns[name].append(val)
+            else:
+                chars[n] = char  # Maybe evicted and loaded again as a new object
+                rows[n] = char._row
+                for name, val in zip(schema, values):
+                    columns[name][n] = val
+        # The per-tick columns are read straight out of the store, all at once
+        hot = self.store.values([name for name in self.schema if name in character.STORE_COLUMNS], rows)
+        for name, values in hot.items():
+            for n in gone:
+                values[n] = getattr(chars[n], name)  # Evicted, they have their own copy of the row
+            columns[name] = values
+        self.flush()
+        return self.db.snapshot(self.snapshot, columns)
+
     def updatedb(self):
         """
-        Save every character to the database
+        Save every character to the database. Cold columns are only written if they've changed.
         :return: None
         """
-        for char_id in self.chars:
-            char = self.chars[char_id]
-            # devmsg(f"updating {char.nick}")
-            self.update(char)
-        devmsg('updated whole db')
+        if not self.schema:
+            self.load_schema()
+        chars = list(self.chars.values())
+        new_chars = [c for c in chars if c._new]
+        old_chars = [c for c in chars if not c._new]
+        for char in chars:
+            char.pop_changes()
+            char._new = False
+        self.dirty.clear()
+        ticked = self.store.pop_ticked()
+        statements = []
+        cols = tuple(col for col in self.schema if col in character.COLUMNS and col != 'id')
+        if new_chars:
+            statements.append(self.replace(new_chars))
+        if old_chars:
+            statements.append((
+                self.update_query(cols),
+                [tuple(getattr(c, col) for col in cols) + (c.id,) for c in old_chars]
+            ))
+            cold_chars = [c for c in old_chars if c.id in self.cold.pinned and c.id not in self.cold.loading]
+            for c in old_chars:
+                if c.id in self.cold.loading:
+                    # Only what was set is known yet, so only that is written, on the next flush()
+                    c.keep_changes(self.cold.loading[c.id])
+                    self.dirty.add(c.id)
+            if cold_chars:
+                cols = self.cold.columns
+                statements.append((
+                    self.update_query(cols),
+                    [tuple(getattr(c, col) for col in cols) + (c.id,) for c in cold_chars]
+                ))
+        changes = [None] * len(new_chars) + [cols + tuple(self.cold.columns)] * len(old_chars)
+        self.submit(statements, new_chars + old_chars, changes, ticked)
+        devmsg('queued whole db')
+
+    # Column values for a fresh game, set by zero()
+    RESET = {
+        'level': 0, 'next_ttl': 600, 'idled': 0, 'pen_msg': 0, 'pen_nick': 0, 'pen_part': 0,
+        'pen_kick': 0, 'pen_quit': 0, 'pen_quest': 0, 'pen_logout': 0, 'powerpots': 0, 'luckpots': 0,
+        'alignment': 'n', 'gold': 0, 'ffight': 0, 'bwon': 0, 'blost': 0, 'badd': 0,
+        'bminus': 0, 'regentm': 0, 'challengetime': 0, 'hero': 0, 'hlevel': 0, 'engineer': 0,
+        'englevel': 0, 'slaytime': 0, 'bet': 0, 'pot': 0, 'bank': 0,
+    }
 
     def zero(self):
+        """
+        Reset every character for a fresh game
+        :return: None
+        """
+        if self.resident is not None:
+            # Characters that aren't in memory are reset in the database
+            values = dict(self.RESET, **{item: '0' for item in character.ITEMS})
+            assignments = ", ".join(f"{col} = ?" for col in values)
+            self.db.submit([(f"update characters set {assignments}", [tuple(values.values())])])
         for char in self.chars.values():
-            char.level = 0
-            char.next_ttl = 600
-            char.idled = 0
-            char.pen_msg = 0
-            char.pen_nick = 0
-            char.pen_part = 0
-            char.pen_kick = 0
-            char.pen_quit = 0
-            char.pen_quest = 0
-            char.pen_logout = 0
-            char.amulet = '0'
-            char.charm = '0'
-            char.helm = '0'
-            char.boots = '0'
-            char.gloves = '0'
-            char.ring = '0'
-            char.legs = '0'
-            char.shield = '0'
-            char.tunic = '0'
-            char.weapon = '0'
-            char.powerpots = 0
-            char.luckpots = 0
-            char.alignment = 'n'
-            char.gold = 0
-            char.ffight = 0
-            char.bwon = 0
-            char.blost = 0
-            char.badd = 0
-            char.bminus = 0
-            char.regentm = 0
-            char.challengetime = 0
-            char.hero = 0
-            char.hlevel = 0
-            char.engineer = 0
-            char.englevel = 0
-            char.slaytime = 0
-            char.bet = 0
-            char.pot = 0
-            char.bank = 0
+            for col, val in self.RESET.items():
+                setattr(char, col, val)
+            for item in character.ITEMS:
+                char.set_item(item, '0')
             self.update(char)
 
     def update(self, c) -> None:
         """
-        Save a character object back to the database
+        Save a character object back to the database.
+        In write-behind mode this only queues the character for the next flush().
         :param c: Character object
         :return: None
         """
-        cursor = self.dbh.cursor()
+        if self.write_behind:
+            self.dirty.add(c.id)
+            return
+        self.dirty.discard(c.id)
+        self.write([c])
+
+    def flush(self) -> int:
+        """
+        Write every dirty character to the database in a single transaction
+        :return: count of characters written
+        """
+        while self.finished:
+            self.written(*self.finished.popleft())
+        ticked = self.store.pop_ticked()
+        chars = [self.chars[char_id] for char_id in self.dirty if char_id in self.chars]
+        self.dirty.clear()
+        if chars or len(ticked):
+            self.write(chars, ticked)
+        # Characters are only dropped once their last write is done, in case it fails
+        self.evict()
+        self.cold.trim()
+        # devmsg(f"flushed {len(chars)} characters and {len(ticked)} ticks")
+        return len(chars) + len(ticked)
+
+    def tick(self, now: int) -> list:
+        """
+        Move the game clock forward. Online characters' next_ttl and idled follow it.
+        :param now: current time
+        :return: list of Character objects that are due to level up
+        """
+        rows = self.store.tick(now)
+        ids = self.store.ids
+        due = [self.chars[int(ids[row])] for row in rows]
+        if not self.write_behind:
+            self.flush()
+        return due
+
+    def requeue(self, chars) -> None:
+        """
+        Hand characters from tick() back, for when levelling them up was cut short
+        :param chars: list of Character objects
+        :return: None
+        """
+        self.store.requeue([char._row for char in chars if self.chars.get(char.id) is char])
+
+    def set_clock(self, now: int) -> None:
+        """
+        Move the game clock forward without levelling anyone up yet
+        :param now: current time
+        :return: None
+        """
+        self.store.clock = max(self.store.clock, now)
+
+    def move(self, mapx: int, mapy: int) -> list:
+        """
+        Move every online character around the map, all at once
+        :param mapx: map width
+        :param mapy: map height
+        :return: list of (mover, occupant) Character pairs that ended up on the same spot
+        """
+        movers, occupants = self.store.move(mapx, mapy)
+        ids = self.store.ids
+        chars = self.chars
+        collisions = [
+            (chars[int(ids[mover])], chars[int(ids[occupant])])
+            for mover, occupant in zip(movers, occupants)
+        ]
+        if not self.write_behind:
+            self.flush()
+        return collisions
+
+    def write(self, chars, ticked=()) -> None:
+        """
+        Queue character objects to be written to the database in one transaction.
+        Their values are taken now, the writing happens on the database thread.
+        New characters are written whole, the rest only get their changed columns updated,
+        with one statement per distinct set of changed columns.
+        :param chars: list of Character objects
+        :param ticked: array of CharStore rows whose next_ttl, idled, x_pos and y_pos need saving
+        :return: None
+        """
+        new_chars = []
+        groups = {}  # Tuple of changed column names to the characters that changed them
+        for c in chars:
+            changed = c.pop_changes()
+            if c._new:
+                c._new = False
+                new_chars.append(c)
+            elif changed:
+                groups.setdefault(changed, []).append(c)
+        if not new_chars and not groups and len(ticked) == 0:
+            return
+        statements = []
+        written = list(new_chars)
+        changes = [None] * len(new_chars)  # Columns written for each, None for the whole row
+        if new_chars:
+            statements.append(self.replace(new_chars))
+        if len(ticked):
+            store = self.store
+            statements.append((
+                "update characters set next_ttl = ?, idled = ?, x_pos = ?, y_pos = ? where id = ?",
+                list(zip(
+                    store.column('next_ttl')[ticked].tolist(),
+                    store.column('idled')[ticked].tolist(),
+                    store.x_pos[ticked].tolist(),
+                    store.y_pos[ticked].tolist(),
+                    store.ids[ticked].tolist(),
+                ))
+            ))
+        for cols, group in groups.items():
+            statements.append((
+                self.update_query(cols),
+                [tuple(getattr(c, col) for col in cols) + (c.id,) for c in group]
+            ))
+            written.extend(group)
+            changes.extend([cols] * len(group))
+        self.submit(statements, written, changes, ticked)
+
+    def submit(self, statements: list, chars: list, changes: list, ticked=()) -> None:
+        """
+        Queue statements writing characters. If they fail, what they wrote is put back for the next flush().
+        :param statements: list of (query, list of parameter tuples)
+        :param chars: list of the Character objects written
+        :param changes: list of the tuple of columns written for each character, None for a whole new row
+        :param ticked: array of CharStore rows written
+        :return: None
+        """
+        for c in chars:
+            self.writing[c.id] = self.writing.get(c.id, 0) + 1
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+
+        def done(future):
+            # On the database thread
+            if loop is None or loop.is_closed():
+                self.finished.append((future, chars, changes, ticked))
+            else:
+                loop.call_soon_threadsafe(self.written, future, chars, changes, ticked)
+        self.db.submit(statements).add_done_callback(done)
+
+    def written(self, future, chars: list, changes: list, ticked) -> None:
+        """
+        Called once a write from submit() has finished. Their cold columns can be dropped and fetched
+        again now, or if it failed, the characters are marked dirty again with the columns it held.
+        :param future: the write's Future
+        :param chars: list of Character objects written
+        :param changes: list of the columns written for each character, None for a whole new row
+        :param ticked: array of CharStore rows written
+        :return: None
+        """
+        for c in chars:
+            count = self.writing.pop(c.id, 1) - 1
+            if count:
+                self.writing[c.id] = count
+        if future.exception() is None:
+            self.cold.unpin([c.id for c in chars if c.id not in self.dirty])
+            return
+        devmsg(f"writing {len(chars)} characters failed, trying again on the next flush")
+        for c, cols in zip(chars, changes):
+            if self.chars.get(c.id) is not c:
+                continue
+            if cols is None:
+                c._new = True
+            else:
+                c.keep_changes(cols)
+            self.dirty.add(c.id)
+        if len(ticked):
+            self.store.ticked[ticked] = True
+
+    def update_query(self, cols: tuple) -> str:
+        """
+        Get the update statement for a set of columns, building it the first time it's needed
+        :param cols: tuple of column names
+        :return: SQL string taking the column values and then the character id
+        """
+        query = self.update_queries.get(cols)
+        if query is None:
+            assignments = ", ".join(f"{col} = ?" for col in cols)
+            query = f"update characters set {assignments} where id = ?"
+            self.update_queries[cols] = query
+        return query
+
+    @staticmethod
+    def replace(chars) -> tuple:
+        """
+        Build the statement that writes whole character rows, inserting any that don't exist yet
+        :param chars: list of Character objects
+        :return: (query, list of parameter tuples)
+        """
         query = f"""replace into characters (
             password, is_admin,  level,    next_ttl, nick,     userhost,      online,     idled,     x_pos,     y_pos,     -- 10
             pen_msg,  pen_nick,  pen_part, pen_kick, pen_quit, pen_quest,     pen_logout, created,   lastlogin, amulet,    -- 20
@@ -216,149 +758,117 @@ class Characters:
             ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, -- 60
             ?                             -- 61
         )"""
-        cursor.execute(
+        return (
             query,
-            (
-                c.password,      c.is_admin,   c.level,     c.next_ttl,  c.nick,       # 05
-                c.userhost,      c.online,     c.idled,     c.x_pos,     c.y_pos,      # 10
-                c.pen_msg,       c.pen_nick,   c.pen_part,  c.pen_kick,  c.pen_quit,   # 15
-                c.pen_quest,     c.pen_logout, c.created,   c.lastlogin, c.amulet,     # 20
-                c.charm,         c.helm,       c.boots,     c.gloves,    c.ring,       # 25
-                c.legs,          c.shield,     c.tunic,     c.weapon,    c.powerpots,  # 30
-                c.luckpots,      c.alignment,  c.gold,      c.ffight,    c.bwon,       # 35
-                c.blost,         c.badd,       c.bminus,    c.rname,     c.avatar,     # 40
-                c.sex,           c.age,        c.location,  c.email,     c.regentm,    # 45
-                c.challengetime, c.hero,       c.hlevel,    c.engineer,  c.englevel,   # 50
-                c.slaytime,      c.bet,        c.pot,       c.network,   c.bank,       # 55
-                c.team,          c.luckload,   c.powerload, c.id,        c.username,   # 60
-                c.charclass                                                            # 61
-            )
+            [
+                (
+                    c.password,      c.is_admin,   c.level,     c.next_ttl,  c.nick,       # 05
+                    c.userhost,      c.online,     c.idled,     c.x_pos,     c.y_pos,      # 10
+                    c.pen_msg,       c.pen_nick,   c.pen_part,  c.pen_kick,  c.pen_quit,   # 15
+                    c.pen_quest,     c.pen_logout, c.created,   c.lastlogin, c.amulet,     # 20
+                    c.charm,         c.helm,       c.boots,     c.gloves,    c.ring,       # 25
+                    c.legs,          c.shield,     c.tunic,     c.weapon,    c.powerpots,  # 30
+                    c.luckpots,      c.alignment,  c.gold,      c.ffight,    c.bwon,       # 35
+                    c.blost,         c.badd,       c.bminus,    c.rname,     c.avatar,     # 40
+                    c.sex,           c.age,        c.location,  c.email,     c.regentm,    # 45
+                    c.challengetime, c.hero,       c.hlevel,    c.engineer,  c.englevel,   # 50
+                    c.slaytime,      c.bet,        c.pot,       c.network,   c.bank,       # 55
+                    c.team,          c.luckload,   c.powerload, c.id,        c.username,   # 60
+                    c.charclass                                                            # 61
+                )
+                for c in chars
+            ]
         )
-        cursor.close()
-        self.dbh.commit()
-
-    def filter(self, online: int = None, alignment: str = None, levelplus: int = None,
-               levelminus: int = None, charsumplus: int = None, charsumminus: int = None,
-               notnamed: str = None, debug: bool = False):
-        """
-        Get various lists of characters, with varying levels of specificity
-        :param online:       Filter by online status
-        :param alignment:    Filter by alignment
-        :param levelplus:    Filter by char >= level
-        :param levelminus:   Filter by char <= level
-        :param charsumplus:  Filter by character itemsum >= charsum
-        :param charsumminus: Filter by character itemsum <= charsum
-        :param notnamed:     Filter by character username != notnamed
-        :param debug:        Emit debug log messages
+
+    def opponents(self, char, levelminus: int, charsumplus: float, charsumminus: float) -> list:
+        """
+        Find online characters fit to fight a character, by a range lookup on item sum
+        :param char: Character object looking for a fight, never included
+        :param levelminus: Opponent level must be <= this
+        :param charsumplus: Opponent itemsum must be >= this
+        :param charsumminus: Opponent itemsum must be <= this
         :return: List of character IDs
         """
-        char_list = []
-        for c in self.chars:
-            char = self.chars[c]
-            u = char.username
-            if online is not None and char.online != online:
-                if debug: devmsg(f"{u} online disq: want {online} but {u} is {char.online}")
-                continue
-            if alignment is not None and char.alignment != alignment:
-                if debug: devmsg(f"{u} align disq: want {alignment} but {u} is {char.alignment}")
-                continue
-            if levelplus is not None and char.level < levelplus:
-                if debug: devmsg(f"{u} level < disq: want {levelplus}+ but {u} is {char.level}")
-                continue
-            if levelminus is not None and char.level > levelminus:
-                if debug: devmsg(f"{u} level > disq: want {levelminus}- but {u} is {char.level}")
-                continue
-            if charsumplus is not None and char.itemsum() < charsumplus:
-                if debug: devmsg(f"{u} sum < disq: want {charsumplus}+ but {u} is {char.itemsum()}")
-                continue
-            if charsumminus is not None and char.itemsum() > charsumminus:
-                if debug: devmsg(f"{u} sum > disq: want {charsumminus}- but {u} is {char.itemsum()}")
-                continue
-            if notnamed is not None and char.username == notnamed:
-                if debug: devmsg(f"{u} name disq: {char.username} == {notnamed}")
-                continue
-            char_list.append(c)
-        return char_list
-
-    def online(self, user_id: int = None, status: int = None, alignment: str = None,
-               levelplus: int = None, levelminus: int = None):
-        """
-        Get a list of online users when no user or status specified
-        :param user_id: Optional user id to check online status of
-        :param status: Optional status to set a user to (user must be specified)
-        :param alignment: Option alignment to filter the count. Cannot be used with user_id or status
-        :param levelplus: Optional char >= level to filter the count. Cannot be used with user_id or status
-        :param levelminus: Optional char <= level to filter the count. Cannot be used with user_id or status
-        :return: List of IDs, or 0 or 1 for status get/set
-        """
-        # devmsg('start')
-        if user_id is None:
-            char_list = []
-            for c in self.chars:
-                char = self.chars[c]
-                # devmsg(f"c: {c}")
-                if char.online == 1:
-                    char_list.append(c)
-            # devmsg(f"ended: {char_list}")
-            return char_list
+        entries = self.online_by_sum
+        low = bisect_left(entries, (charsumplus,))
+        high = bisect_right(entries, (charsumminus, math.inf))
+        indexed = self.indexed
+        char_id = char.id
+        return [
+            opponent_id for item_sum, opponent_id in entries[low:high]
+            if opponent_id != char_id and indexed[opponent_id][1] <= levelminus
+        ]
 
+    def online_count(self, alignment: str = None, levelplus: int = None) -> int:
+        """
+        Count online characters without building a list
+        :param alignment: Optional alignment to filter the count
+        :param levelplus: Optional char >= level to filter the count
+        :return: count of online characters
+        """
         if alignment is not None:
-            char_list = []
-            for c in self.chars:
-                char = self.chars[c]
-                if char.online == 1 and char.alignment == alignment:
-                    char_list.append(c)
-            return char_list
-
+            return len(self.online_by_alignment[alignment])
         if levelplus is not None:
-            char_list = []
-            for c in self.chars:
-                char = self.chars[c]
-                if char.level >= levelplus:
-                    char_list.append(c)
-            return char_list
-
-        if levelminus is not None:
-            char_list = []
-            for c in self.chars:
-                char = self.chars[c]
-                if char.level <= levelplus:
-                    char_list.append(c)
-            return char_list
+            return sum(len(ids) for level, ids in self.online_by_level.items() if level >= levelplus)
+        return len(self.online_ids)
 
-        if status is None:
-            return self.chars[user_id].online
-
-        self.chars[user_id].online = status
-        return status
+    def random_online(self, alignment: str = None):
+        """
+        Pick a random online character
+        :param alignment: Optional alignment to pick from
+        :return: Character object, or None if nobody is online
+        """
+        if alignment is None:
+            char_id = self.online_ids.choice()
+        else:
+            char_id = self.online_by_alignment[alignment].choice()
+        if char_id is None:
+            return None
+        return self.chars[char_id]
 
-    async def topx(self, count=5):
+    async def topx(self, count=5, start=0):
         """
         Return the character objects, sorted by highest level and lowest ttl
         :param count: Limit the list to the top count, defaults to 5. None for all.
+        :param start: Position in the ranking to start from, for paging
         :return: list of character objects
         """
-        devmsg('started')
-        timered = sorted(self.chars.values(), key=attrgetter('next_ttl'))
-        leveled = sorted(timered, key=attrgetter('level'), reverse=True)
-        devmsg("0's ttl: " + str(leveled[0].next_ttl))
-        devmsg('ended')
-        if count is None:
-            return leveled
-        return leveled[:count]
+        return await self.fetch(await self.ranking.ordered('top', start=start, count=count))
 
-    def webchars(self):
+    def hydrated(self, chars):
+        """
+        Fetch the cold columns of characters about to be shown, all together, for the length of a with block
+        :param chars: iterable of Character objects
+        :return: async context manager
+        """
+        return self.cold.hydrated([c.id for c in chars])
+
+    async def webchars(self, sort: str = None):
         """
         Return all the characters, sorted as topx, in a mutable dict format
-        suitable for jinja2 templates
+        suitable for jinja2 templates. Render them inside hydrated().
+        :param sort: Optional db.html sort order, like 'cmp_level_desc'
         :return: dict of character ids to character objects
         """
-        devmsg('started')
-        timered = sorted(self.chars.values(), key=attrgetter('next_ttl'))
-        leveled = sorted(timered, key=attrgetter('level'), reverse=True)
-        devmsg("0's ttl: " + str(leveled[0].next_ttl))
-        devmsg('ended')
-        return {x.id: x for x in leveled}
+        key = 'top'
+        reverse = False
+        if sort is not None:
+            parts = sort.split('_')
+            if len(parts) == 3 and parts[0] == 'cmp' and parts[2] in ('asc', 'desc'):
+                key = parts[1]
+                reverse = parts[2] == 'desc'
+            else:
+                devmsg(f"ignoring unknown sort '{sort}'")
+        chars = await self.fetch(await self.ranking.ordered(key, reverse=reverse))
+        return {x.id: x for x in chars}
+
+    async def rank(self, char, sort: str = 'top') -> int:
+        """
+        :param char: Character object
+        :param sort: Sort order to rank by, defaults to the topx order
+        :return: 1-based rank of the character
+        """
+        return await self.ranking.rank(char, sort)
 
 
 """
@@ -430,11 +940,3 @@ CREATE TABLE "CHARACTERS" (
 )
 """
 
-
-if __name__ == "__main__":
-    import sqlite3
-    dbh = sqlite3.connect('irpg.db')
-    characters = Characters(dbh)
-    characters.load()
-    charlist = characters.filter(debug=True, online=1, levelplus=5, levelminus=15)
-    devmsg(f"charlist: {charlist}")
@@ -0,0 +1,270 @@
+"""
+This file contains the columnar storage for the character fields the game loop touches every tick
+"""
+import heapq
+import numpy as np
+import time
+
+
+class CharStore:
+    """
+    Per-tick character fields held in NumPy arrays, one row per character.
+    Character objects read and write their own row through properties.
+
+    Online characters don't count down: they hold an absolute level-up deadline in a min-heap,
+    and their next_ttl and idled are worked out from the clock when read. Offline characters
+    keep frozen next_ttl and idled values instead.
+    """
+    ALIGNMENTS = ('n', 'g', 'e')  # alignment code -> alignment letter
+    ALIGN_CODES = {letter: code for code, letter in enumerate(ALIGNMENTS)}
+
+    def __init__(self, capacity: int = 1024):
+        """
+        :param capacity: Number of rows to allocate up front. Grows as needed.
+        """
+        self.size = 0
+        self.clock = int(time.time())  # Logical time of the current tick
+        self.heap = []  # Min-heap of (deadline, row). Entries that no longer match deadline are skipped.
+        self.free = []  # Rows given back by remove(), to be used again by add()
+        self.ids = np.zeros(capacity, dtype=np.int64)
+        self.level = np.zeros(capacity, dtype=np.int64)
+        self.next_ttl = np.zeros(capacity, dtype=np.int64)     # frozen while offline
+        self.idled = np.zeros(capacity, dtype=np.int64)        # frozen while offline
+        self.deadline = np.zeros(capacity, dtype=np.int64)     # clock to level up at, while online
+        self.idle_origin = np.zeros(capacity, dtype=np.int64)  # clock idled counts from, while online
+        self.online = np.zeros(capacity, dtype=np.int8)
+        self.x_pos = np.zeros(capacity, dtype=np.int32)
+        self.y_pos = np.zeros(capacity, dtype=np.int32)
+        self.align = np.zeros(capacity, dtype=np.int8)
+        self.ticked = np.zeros(capacity, dtype=bool)  # rows moved or frozen since the last save
+        self.used = np.zeros(capacity, dtype=bool)    # rows holding a character
+        self.rng = np.random.default_rng()
+
+    def columns(self):
+        """
+        :return: list of the names of every array in the store
+        """
+        return [
+            'ids', 'level', 'next_ttl', 'idled', 'deadline', 'idle_origin',
+            'online', 'x_pos', 'y_pos', 'align', 'ticked', 'used',
+        ]
+
+    def add(self, char_id: int) -> int:
+        """
+        Allocate a row for a character
+        :param char_id: character's id
+        :return: row number
+        """
+        if self.free:
+            row = self.free.pop()
+        else:
+            if self.size == len(self.ids):
+                self.grow()
+            row = self.size
+            self.size += 1
+        self.ids[row] = char_id
+        self.used[row] = True
+        return row
+
+    def remove(self, row: int) -> None:
+        """
+        Give back an offline character's row, clearing it for the next add()
+        :param row: row number
+        :return: None
+        """
+        for name in self.columns():
+            getattr(self, name)[row] = 0
+        self.free.append(row)
+
+    def grow(self) -> None:
+        """
+        Double the capacity of every array
+        :return: None
+        """
+        capacity = len(self.ids) * 2
+        for name in self.columns():
+            old = getattr(self, name)
+            new = np.zeros(capacity, dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def get_next_ttl(self, row: int) -> int:
+        """
+        :param row: character's row
+        :return: seconds until the character levels up
+        """
+        if self.online[row]:
+            return int(self.deadline[row]) - self.clock
+        return int(self.next_ttl[row])
+
+    def set_next_ttl(self, row: int, seconds: int) -> None:
+        """
+        :param row: character's row
+        :param seconds: seconds until the character levels up
+        :return: None
+        """
+        if self.online[row]:
+            self.schedule(row, self.clock + int(seconds))
+        else:
+            self.next_ttl[row] = seconds
+
+    def get_idled(self, row: int) -> int:
+        """
+        :param row: character's row
+        :return: seconds the character has idled in total
+        """
+        if self.online[row]:
+            return self.clock - int(self.idle_origin[row])
+        return int(self.idled[row])
+
+    def set_idled(self, row: int, seconds: int) -> None:
+        """
+        :param row: character's row
+        :param seconds: seconds the character has idled in total
+        :return: None
+        """
+        if self.online[row]:
+            self.idle_origin[row] = self.clock - int(seconds)
+        else:
+            self.idled[row] = seconds
+
+    def set_online(self, row: int, online: int) -> None:
+        """
+        Start a character's clock running when they come online, and freeze it when they leave
+        :param row: character's row
+        :param online: 1 for online, 0 for offline
+        :return: None
+        """
+        was_online = self.online[row]
+        if online and not was_online:
+            self.online[row] = online
+            self.idle_origin[row] = self.clock - self.idled[row]
+            self.schedule(row, self.clock + int(self.next_ttl[row]))
+        elif was_online and not online:
+            self.next_ttl[row] = self.deadline[row] - self.clock
+            self.idled[row] = self.clock - self.idle_origin[row]
+            self.online[row] = online
+            self.ticked[row] = True
+        else:
+            self.online[row] = online
+
+    def schedule(self, row: int, deadline: int) -> None:
+        """
+        Set when an online character levels up. Any earlier heap entry for them goes stale.
+        :param row: character's row
+        :param deadline: clock to level up at
+        :return: None
+        """
+        self.deadline[row] = deadline
+        heapq.heappush(self.heap, (deadline, row))
+
+    def column(self, name: str):
+        """
+        Get the current values of a column for every row, working out next_ttl and idled for online rows
+        :param name: column name
+        :return: array
+        """
+        n = self.size
+        if name == 'next_ttl':
+            return np.where(self.online[:n] == 1, self.deadline[:n] - self.clock, self.next_ttl[:n])
+        if name == 'idled':
+            return np.where(self.online[:n] == 1, self.clock - self.idle_origin[:n], self.idled[:n])
+        return getattr(self, name)[:n]
+
+    def values(self, names, rows) -> dict:
+        """
+        Copy columns' values for some rows, with alignment as letters like the Character property gives it
+        :param names: iterable of column names
+        :param rows: list of row numbers
+        :return: dict of column name to array of values, in the same order as rows
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        values = {}
+        for name in names:
+            if name == 'alignment':
+                values[name] = np.array(self.ALIGNMENTS)[self.align[rows]]
+            else:
+                values[name] = self.column(name)[rows]
+        return values
+
+    def tick(self, now: int):
+        """
+        Move the clock forward and find who is due to level up
+        :param now: current time
+        :return: list of rows that are due to level up
+        """
+        self.clock = max(self.clock, now)
+        heap = self.heap
+        online = self.online
+        deadline = self.deadline
+        due = []
+        while heap and heap[0][0] <= self.clock:
+            when, row = heapq.heappop(heap)
+            if online[row] and deadline[row] == when:
+                due.append(row)
+        # Stale entries pile up as penalties and fights move deadlines; rebuild now and then
+        if len(heap) > 2 * self.size + 1024:
+            self.rebuild_heap()
+        return due
+
+    def requeue(self, rows) -> None:
+        """
+        Put rows that tick() handed out back on the heap at their current deadline,
+        for when they couldn't all be levelled up, so they come up again next tick.
+        Rows whose deadline has moved on since were scheduled afresh and are left alone.
+        :param rows: iterable of rows
+        :return: None
+        """
+        online = self.online
+        deadline = self.deadline
+        for row in rows:
+            if online[row] and deadline[row] <= self.clock:
+                heapq.heappush(self.heap, (int(deadline[row]), row))
+
+    def rebuild_heap(self) -> None:
+        """
+        Make a fresh heap holding only the current deadline of each online row
+        :return: None
+        """
+        rows = np.nonzero(self.online[:self.size] == 1)[0]
+        self.heap = list(zip(self.deadline[rows].tolist(), rows.tolist()))
+        heapq.heapify(self.heap)
+
+    def move(self, mapx: int, mapy: int):
+        """
+        Move every online character up to one spot in any direction, wrapping around the map edges
+        :param mapx: map width
+        :param mapy: map height
+        :return: two arrays of rows, the characters that moved onto an occupied spot and who was there first
+        """
+        n = self.size
+        rows = np.nonzero(self.online[:n] == 1)[0]
+        count = len(rows)
+        if count == 0:
+            return rows, rows
+        moves = self.rng.integers(-1, 2, size=(2, count))  # -1, 0, or 1
+        x = (self.x_pos[rows] + moves[0]) % mapx
+        y = (self.y_pos[rows] + moves[1]) % mapy
+        self.x_pos[rows] = x
+        self.y_pos[rows] = y
+        self.ticked[rows] = True
+        # Characters on the same spot share a key. A stable sort keeps them in row order,
+        # so the first two of each shared key are who was there and who bumped into them.
+        keys = x.astype(np.int64) * mapy + y
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+        firsts = np.nonzero(np.r_[True, keys[1:] != keys[:-1]])[0]
+        firsts = firsts[firsts + 1 < count]
+        firsts = firsts[keys[firsts + 1] == keys[firsts]]
+        return rows[order[firsts + 1]], rows[order[firsts]]
+
+    def pop_ticked(self):
+        """
+        Get the rows whose next_ttl, idled or position changed since the last call,
+        which is every online row plus any moved or frozen, and start tracking afresh
+        :return: array of rows
+        """
+        n = self.size
+        rows = np.nonzero(self.ticked[:n] | (self.online[:n] == 1))[0]
+        self.ticked[:n] = False
+        return rows
@@ -0,0 +1,238 @@
+"""
+This file contains the cache of rarely used character columns, which stay in the database until needed
+"""
+import asyncio
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from devmsg import devmsg
+
+
+class ColdMiss(LookupError):
+    """
+    A cold column was read on the event loop before its values were fetched
+    """
+
+
+class ColdCache:
+    """
+    Cold columns (password, email...) of the characters that used them lately, fetched from the
+    database on first use and forgotten again least recently used first.
+
+    Values changed since the last write are pinned, so they can't be forgotten before they're saved.
+
+    Readers should use hydrated() first. A miss on the event loop never waits for the database:
+    it hands back an empty dict, which is filled in once the values arrive. Reading a column
+    from it before then raises.
+    """
+    batch = 500  # Most ids to ask the database for in one query
+
+    def __init__(self, db, columns, maxlen: int = 1000):
+        """
+        :param db: database.Database to fetch from
+        :param columns: names of the cold columns
+        :param maxlen: most characters to keep values for, pinned ones aside
+        """
+        self.db = db
+        self.columns = tuple(columns)
+        self.maxlen = maxlen
+        self.entries = OrderedDict()  # Dict of character id to dict of column values, oldest first
+        self.pinned = {}              # Dict of character id to dict of column values not saved yet
+        self.loading = {}             # Dict of character id to the dict handed out on a miss, until fetched
+        self.lent = {}                # Dict of character id to [values, pages using them], from hydrated()
+        self.queued = []              # IDs missed since the last fetch_queued()
+        self.hits = 0
+        self.misses = 0
+        self.query = f"select id, {', '.join(self.columns)} from characters where id in "
+
+    def get(self, char_id: int) -> dict:
+        """
+        Get a character's cold values. If we don't have them they're fetched in the background,
+        and until then this gives a dict that only holds whatever has been set in it.
+        :param char_id: character's id
+        :return: dict of column name to value
+        """
+        values = self.pinned.get(char_id)
+        if values is not None:
+            return values
+        values = self.entries.get(char_id)
+        if values is not None:
+            self.hits += 1
+            self.entries.move_to_end(char_id)
+            return values
+        lent = self.lent.get(char_id)
+        if lent is not None:
+            return lent[0]
+        values = self.loading.get(char_id)
+        if values is not None:
+            return values
+        self.misses += 1
+        values = self.loading[char_id] = {}
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Not on the event loop, so there's nothing to hold up by waiting
+            self.store(self.fetch([char_id]).result())
+            self.settle([char_id])
+            self.trim()
+            return values
+        if not self.queued:
+            loop.create_task(self.fetch_queued())
+        self.queued.append(char_id)
+        return values
+
+    async def fetch_queued(self) -> None:
+        """
+        Fetch the values of every character missed since the last call
+        :return: None
+        """
+        char_ids = self.queued
+        self.queued = []
+        for start in range(0, len(char_ids), self.batch):
+            self.store(await self.read(char_ids[start:start + self.batch]))
+        self.settle(char_ids)
+        self.trim()
+
+    def settle(self, char_ids) -> None:
+        """
+        Cache whatever was handed out for characters the database had no row for
+        :param char_ids: ids just fetched
+        :return: None
+        """
+        for char_id in char_ids:
+            values = self.loading.pop(char_id, None)
+            if values is not None and char_id not in self.pinned:
+                self.entries[char_id] = values
+
+    def put(self, char_id: int, values: dict, pin: bool = False) -> None:
+        """
+        Hand over a character's cold values, for characters loaded or made in full
+        :param char_id: character's id
+        :param values: dict of column name to value
+        :param pin: True if the values aren't in the database yet
+        :return: None
+        """
+        if pin:
+            self.entries.pop(char_id, None)
+            self.pinned[char_id] = values
+        else:
+            self.entries[char_id] = values
+            self.trim()
+
+    def pin(self, char_id: int) -> None:
+        """
+        Keep a character's values until unpin(), because they've changed
+        :param char_id: character's id
+        :return: None
+        """
+        if char_id not in self.pinned:
+            self.pinned[char_id] = self.get(char_id)
+            self.entries.pop(char_id, None)
+
+    def unpin(self, char_ids) -> None:
+        """
+        Let characters' values be forgotten again, once their changes are written
+        :param char_ids: iterable of character ids
+        :return: None
+        """
+        for char_id in char_ids:
+            values = self.pinned.pop(char_id, None)
+            if values is not None:
+                self.entries[char_id] = values
+
+    def fetch(self, char_ids: list):
+        """
+        Ask the database for characters' cold values
+        :param char_ids: list of character ids, no more than batch of them
+        :return: Future of (column names, rows)
+        """
+        return self.db.query(self.query + f"({', '.join('?' * len(char_ids))})", tuple(char_ids))
+
+    async def read(self, char_ids: list):
+        """
+        Ask the database for characters' cold values from the event loop
+        :param char_ids: list of character ids, no more than batch of them
+        :return: (column names, rows)
+        """
+        return await self.db.read(self.query + f"({', '.join('?' * len(char_ids))})", tuple(char_ids))
+
+    def store(self, result) -> None:
+        """
+        Cache rows fetched from the database
+        :param result: (column names, rows) with the id first
+        :return: None
+        """
+        cols, rows = result
+        columns = self.columns
+        for row in rows:
+            char_id = row[0]
+            values = dict(zip(columns, row[1:]))
+            handed_out = self.loading.pop(char_id, None)
+            if handed_out is not None:
+                # Anything set in it while we waited is newer than the database
+                for col, val in values.items():
+                    handed_out.setdefault(col, val)
+                values = handed_out
+            if char_id not in self.pinned:
+                self.entries[char_id] = values
+                self.entries.move_to_end(char_id)
+
+    @asynccontextmanager
+    async def hydrated(self, char_ids):
+        """
+        Fetch the values of all these characters that we don't have, a batch at a time, and keep them
+        only until the with block ends, so a whole page can use them without flooding the cache
+        :param char_ids: iterable of character ids
+        :return: async context manager
+        """
+        borrowed = []
+        try:
+            missing = []
+            for char_id in char_ids:
+                if char_id in self.lent:
+                    self.lent[char_id][1] += 1
+                    borrowed.append(char_id)
+                elif char_id not in self.entries and char_id not in self.pinned:
+                    missing.append(char_id)
+            for start in range(0, len(missing), self.batch):
+                cols, rows = await self.read(missing[start:start + self.batch])
+                for row in rows:
+                    char_id = row[0]
+                    if char_id in self.entries or char_id in self.pinned:
+                        continue  # Someone else got them while we waited
+                    lent = self.lent.get(char_id)
+                    if lent is None:
+                        values = dict(zip(self.columns, row[1:]))
+                        handed_out = self.loading.pop(char_id, None)
+                        if handed_out is not None:
+                            for col, val in values.items():
+                                handed_out.setdefault(col, val)
+                            values = handed_out
+                        lent = self.lent[char_id] = [values, 0]
+                    lent[1] += 1
+                    borrowed.append(char_id)
+            yield
+        finally:
+            for char_id in borrowed:
+                lent = self.lent[char_id]
+                lent[1] -= 1
+                if not lent[1]:
+                    del self.lent[char_id]
+
+    def trim(self) -> None:
+        """
+        Forget the least recently used values beyond maxlen
+        :return: None
+        """
+        entries = self.entries
+        while len(entries) > self.maxlen:
+            entries.popitem(last=False)
+
+    def stats(self) -> str:
+        """
+        :return: one-line summary of the cache
+        """
+        return (
+            f"{len(self.entries)} cached, {len(self.pinned)} pinned, {len(self.lent)} lent, "
+            f"{len(self.loading)} loading, "
+            f"{self.hits} hits, {self.misses} misses"
+        )
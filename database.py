@@ -0,0 +1,253 @@
+"""
+This file contains the database writer, which does all the SQLite work on its own thread
+"""
+import asyncio
+import queue
+import sqlite3
+import threading
+import traceback
+from concurrent.futures import Future
+from devmsg import devmsg
+
+
+class Database:
+    """
+    Owns the SQLite connection and runs every statement on a dedicated thread, in the order
+    they were submitted, so the event loop never waits on the disk.
+
+    Writes are batches of (query, list of parameter tuples), each run with executemany()
+    and committed together. submit() hands back a Future and can be forgotten about;
+    write() is the same thing for coroutines to await.
+
+    Off the event loop, query() and submit() block while maxlen jobs are queued. On it nothing
+    blocks: coroutines use read(), write() and barrier(), which wait their turn without holding up
+    the loop, and code that can't wait checks busy() before submitting.
+
+    Every write batch bumps the generation kept in the database's user_version,
+    which is how a snapshot knows whether the database has moved on since it was taken.
+    """
+    def __init__(self, filename: str = 'irpg.db', maxlen: int = 64):
+        """
+        :param filename: SQLite database file
+        :param maxlen: most jobs to queue before callers wait; busy() says to hold off at half that
+        """
+        self.filename = filename
+        self.maxlen = maxlen
+        self.jobs = queue.Queue()  # (function taking the connection, Future, loop waiting on slots or None)
+        self.room = threading.Condition()         # Notified as jobs finish, for callers off the loop
+        self.slots = asyncio.Semaphore(maxlen)    # Jobs coroutines may have queued at once
+        self.written = 0  # Write batches committed
+        self.rows = 0     # Parameter rows in those batches
+        self.failed = 0   # Jobs that raised an exception
+        self.generation = 0  # Generation of the last write, only touched on the writer thread once open
+        ready = Future()
+        self.thread = threading.Thread(target=self.run, args=(ready,), name='database', daemon=True)
+        self.thread.start()
+        ready.result()  # Raise here if the database can't be opened
+
+    def run(self, ready: Future) -> None:
+        """
+        The writer thread. Opens the database and runs jobs until close()
+        :param ready: Future to resolve once the database is open
+        :return: None
+        """
+        try:
+            dbh = sqlite3.connect(self.filename)
+            # WAL lets readers carry on during writes, and with it synchronous=NORMAL
+            # only syncs at checkpoints while still never corrupting the database.
+            dbh.execute("pragma journal_mode=WAL")
+            dbh.execute("pragma synchronous=NORMAL")
+            self.generation = dbh.execute("pragma user_version").fetchone()[0]
+        except Exception as e:
+            ready.set_exception(e)
+            return
+        ready.set_result(None)
+        while True:
+            job, future, loop = self.jobs.get()
+            if job is None:
+                break
+            # The job runs even if whoever queued it stopped waiting, only its result is dropped
+            waited = future.set_running_or_notify_cancel()
+            try:
+                result = job(dbh)
+            except Exception as e:
+                devmsg(f"Exception: {e}")
+                traceback.print_exc()
+                dbh.rollback()
+                self.failed += 1
+                if waited:
+                    future.set_exception(e)
+            else:
+                if waited:
+                    future.set_result(result)
+            if loop is not None:
+                try:
+                    loop.call_soon_threadsafe(self.slots.release)
+                except RuntimeError:
+                    pass  # The loop has closed, nobody is waiting for the slot
+            with self.room:
+                self.room.notify_all()
+        dbh.close()
+        future.set_result(None)
+
+    def put(self, job) -> Future:
+        """
+        Queue a job for the writer thread. Off the event loop this blocks while the queue is full;
+        on it, it never does.
+        :param job: function taking the connection
+        :return: Future of what the job returns
+        """
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            with self.room:
+                self.room.wait_for(lambda: self.jobs.qsize() < self.maxlen)
+        future = Future()
+        self.jobs.put((job, future, None))
+        return future
+
+    async def enqueue(self, job) -> Future:
+        """
+        Queue a job for the writer thread from the event loop, waiting without blocking it
+        while the queue is full
+        :param job: function taking the connection
+        :return: Future of what the job returns
+        """
+        await self.slots.acquire()
+        future = Future()
+        self.jobs.put((job, future, asyncio.get_running_loop()))
+        return future
+
+    def submit(self, statements: list) -> Future:
+        """
+        Queue a batch of statements to run in one transaction
+        :param statements: list of (query, list of parameter tuples)
+        :return: Future that resolves once they're committed
+        """
+        return self.put(self.transaction(statements))
+
+    def transaction(self, statements: list):
+        """
+        :param statements: list of (query, list of parameter tuples)
+        :return: job running them in one transaction
+        """
+        def job(dbh):
+            cursor = dbh.cursor()
+            for query, rows in statements:
+                cursor.executemany(query, rows)
+                self.rows += len(rows)
+            self.bump(cursor)
+            cursor.close()
+            dbh.commit()
+            self.written += 1
+        return job
+
+    def bump(self, cursor) -> None:
+        """
+        Move to the next generation, as part of the current transaction. Writer thread only.
+        :param cursor: database cursor
+        :return: None
+        """
+        self.generation += 1
+        cursor.execute(f"pragma user_version = {self.generation}")
+
+    def snapshot(self, snapshot, columns: dict) -> Future:
+        """
+        Save a snapshot once everything queued before it is written
+        :param snapshot: snapshot.Snapshot
+        :param columns: dict of column name to list of values, matching what's been queued so far
+        :return: Future that resolves once the snapshot is saved
+        """
+        def job(dbh):
+            cursor = dbh.cursor()
+            self.bump(cursor)
+            cursor.close()
+            dbh.commit()
+            snapshot.save(columns, self.generation)
+        return self.put(job)
+
+    async def write(self, statements: list) -> None:
+        """
+        Run a batch of statements in one transaction and wait for the commit
+        :param statements: list of (query, list of parameter tuples)
+        :return: None
+        """
+        await asyncio.wrap_future(await self.enqueue(self.transaction(statements)))
+
+    def query(self, query: str, params: tuple = ()) -> Future:
+        """
+        Run a select on the writer thread, after everything queued before it
+        :param query: SQL string
+        :param params: query parameters
+        :return: Future of (list of column names, list of rows)
+        """
+        return self.put(self.select(query, params))
+
+    async def read(self, query: str, params: tuple = ()) -> tuple:
+        """
+        Run a select on the writer thread, after everything queued before it, and wait for the rows
+        :param query: SQL string
+        :param params: query parameters
+        :return: (list of column names, list of rows)
+        """
+        return await asyncio.wrap_future(await self.enqueue(self.select(query, params)))
+
+    @staticmethod
+    def select(query: str, params: tuple):
+        """
+        :param query: SQL string
+        :param params: query parameters
+        :return: job running the query
+        """
+        def job(dbh):
+            cursor = dbh.execute(query, params)
+            cols = [x[0] for x in cursor.description]
+            rows = cursor.fetchall()
+            cursor.close()
+            return cols, rows
+        return job
+
+    def busy(self) -> bool:
+        """
+        :return: True if the writer is far enough behind that new writes should wait and be batched up
+        """
+        return self.jobs.qsize() >= self.maxlen // 2
+
+    async def caught_up(self) -> None:
+        """
+        Wait until busy() is over
+        :return: None
+        """
+        while self.busy():
+            await asyncio.sleep(0.05)
+
+    def flush(self) -> None:
+        """
+        Block until everything queued so far has been written
+        :return: None
+        """
+        self.put(lambda dbh: None).result()
+
+    async def barrier(self) -> None:
+        """
+        Wait until everything queued so far has been written
+        :return: None
+        """
+        await asyncio.wrap_future(await self.enqueue(lambda dbh: None))
+
+    def close(self) -> None:
+        """
+        Write everything queued so far, then close the database and stop the thread
+        :return: None
+        """
+        if not self.thread.is_alive():
+            return
+        future = Future()
+        self.jobs.put((None, future, None))
+        future.result()
+
+    def stats(self) -> str:
+        """
+        :return: one-line summary of the writer
+        """
+        return f"queued {self.jobs.qsize()}, {self.written} batches of {self.rows} rows written, {self.failed} failed"
@@ -5,28 +5,35 @@ without affecting the game engine itself.
 """
 import asyncio
 from threading import Thread
+import character
 import characters
+import database
 import discord
 import logging
 import math
 import os
+import outbox
+import registry
+import scheduler
+import shards
 import signal
-import sqlite3
+import snapshot
+import sys
 import time
+import traceback
 
 from dotenv import load_dotenv
-from quart import Quart, request, render_template
-from random import choice, randint, seed, uniform
+from quart import Quart, abort, request, render_template
+from random import choice, randint, seed
 
 from devmsg import devmsg
 
-signal.signal(signal.SIGINT, signal.SIG_DFL)
 logging.basicConfig(level=logging.INFO)
 load_dotenv()
 seed()  # seed random generator
 
 
-class IdleRPG(discord.Client):
+class IdleRPG(discord.AutoShardedClient):
     """
     The class from which all game things happen
     """
@@ -36,11 +43,30 @@ class IdleRPG(discord.Client):
     rppenstep = 1.6    # penalty time = penalty * (rppenstep ** level)
     limitpen = 604800  # penalty max limited to 1 week of seconds
     self_clock = 3     # how often to run the event loop
+    adaptive_clock = True  # run the event loop less often, down to every max_clock seconds, when ticks run long
+    max_clock = 15         # longest time in seconds between event loop runs when adaptive_clock is on
+    tick_budget = 0.5      # fraction of the time between event loop runs a tick should take at most
+    tick_chunk = 100       # most characters to process in a tick before letting Discord and the web server run
+    tick_slice = 0.01      # most seconds to process characters for before letting Discord and the web server run
     mapx = 851         # custom size of map width
     mapy = 700         # custom size of map height
     rpreport = 0       # timestamp for reporting top players
     oldrpreport = 0    # previous value for reporting top players
     lasttime = 1       # last time that rpcheck() was run. Used for time diff to shave next_ttl
+    write_behind = True  # queue character saves and write them in batches instead of committing each change
+    flush_interval = 30  # how often, in seconds, to write changed characters to the database
+    lastflush = 0        # last time that changed characters were flushed to the database
+    resident_limit = None  # most offline characters to keep in memory, None to keep everyone
+    role_workers = 4       # most role changes to have in flight at once
+    role_settle = 2        # seconds to let a member's status settle before changing their roles
+    presence_window = 1    # seconds to gather presence updates for before handling them together
+    announce_limit = 5     # most players to announce one at a time per batch, past which they're summed up
+    penalty_window = 5     # seconds to total up message penalties for before applying them
+    # Kind of message penalty to how it's announced: for one, for several, and in a summary of several players
+    message_reasons = {
+        'message': ("a message", "{} messages", "messages"),
+        'edit':    ("editing a message", "editing {} messages", "editing messages"),
+    }
 
     gamechan = None    # This text channel object will be filled in via on_ready()
     bg_task = None     # This gets set to loop the main loop
@@ -52,21 +78,87 @@ class IdleRPG(discord.Client):
 
     # Track our loop so we don't get multiples started
     loop_started = False
+    ready = False          # True once on_ready has set up every guild
 
     running = True
 
     # Items on the map. Dict of dicts of a list of dicts. It really does make sense.
     map_items = {}
 
+    # Random events: (name, population, average seconds between firings per member of the population, method,
+    # skipped when overloaded). 'good' and 'evil' only count when at least 15% of the characters are online.
+    random_events = (
+        ('monster_hunt',    'online', 24 * 86400, 'monster_hunt',    True),
+        ('hand_of_god',     'online', 20 * 86400, 'hand_of_god',     False),
+        ('group_battle',    'online',  9 * 86400, 'group_battle',    True),
+        ('team_battle',     'online',  9 * 86400, 'team_battle',     True),
+        ('calamity',        'online',  8 * 86400, 'calamity',        False),
+        ('godsend',         'online',  8 * 86400, 'godsend',         False),
+        ('celebrity_fight', 'online',  8 * 14400, 'celebrity_fight', True),
+        ('random_gold',     'online',  8 * 19400, 'random_gold',     True),
+        ('monster_attack',  'online',  8 * 43200, 'monster_attack',  False),
+        ('random_steal',    'good',    8 * 86400, 'random_steal',    True),
+        ('evilness',        'evil',   12 * 86400, 'evilness',        True),
+        ('goodness',        'good',   12 * 86400, 'goodness',        True),
+        ('good_godsend',    'good',   20 * 86400, 'godsend',         False),
+    )
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.dbh = sqlite3.connect('irpg.db')
-        self.characters = characters.Characters(self.dbh)
+        self.db = database.Database('irpg.db')  # Does all the database writing on its own thread
+        self.characters = characters.Characters(
+            self.db, write_behind=self.write_behind, snapshot=snapshot.Snapshot('irpg.snapshot'),
+            resident=self.resident_limit,
+        )
         self.characters.load()
+        self.content = registry.ContentRegistry()
+        self.outbox = outbox.Outbox()  # Game announcements for gamechan
+        self.shard_work = {}  # Dict of shard id to shards.Shard
+        self.events = scheduler.EventScheduler()
+        self.ticker = scheduler.TickScheduler(
+            self.self_clock, self.tick,
+            adaptive=self.adaptive_clock, max_period=self.max_clock, budget=self.tick_budget,
+        )
+        for name, population, period, method, sheddable in self.random_events:
+            self.events.add(name, population, period, (getattr(self, method), sheddable))
+
+    def sigint(self):
+        """
+        Save everyone before exiting on SIGINT.
+        Runs on the event loop between tasks, so nothing is caught halfway through.
+        :return: None
+        """
+        devmsg('caught SIGINT, saving all characters...')
+        if self.loop_started:
+            self.ticker.stop()  # mainloop() saves everyone on its way out
+        else:
+            asyncio.get_running_loop().create_task(self.save_and_exit())
+
+    async def save_all(self):
+        """
+        Apply whatever the shards still have queued, then write out every character,
+        save a snapshot and close the database
+        :return: None
+        """
+        for work in self.shard_work.values():
+            await work.presence.flush()
+            await work.penalties.flush()
+        await self.characters.checkpoint()
+        await self.db.barrier()
+        self.db.close()
+
+    async def save_and_exit(self):
+        """
+        Save everything and exit, for when the game loop isn't running
+        :return: None
+        """
+        await self.save_all()
+        devmsg('...saved, exiting.')
+        sys.exit(0)
 
     async def setup_hook(self) -> None:
         devmsg('Setting up environment...')
-        # self.characters = characters.Characters(self.dbh)
+        # self.characters = characters.Characters(self.db)
         # self.characters.load()
         # TODO: set up monsters
         # TODO: set up items
@@ -75,6 +167,8 @@ class IdleRPG(discord.Client):
 
     async def on_ready(self):
         devmsg(f'Logged in as {self.user} {self.user!r}')
+        # Bring the game clock up to date before anyone comes online
+        self.characters.set_clock(int(time.time()))
         # devmsg(f'guilds: {self.guilds}')
         for guild in self.guilds:
             for role in guild.roles:
@@ -123,29 +217,53 @@ class IdleRPG(discord.Client):
                 if chan.name == 'bot-commands':
                     # devmsg(f'  chan: {chan!r}')
                     pass
-            for member in guild.members:
-                if member.id == self.user.id:
-                    continue
-                # devmsg(f'member: {member!r}')
-                # devmsg(f'member status: {member.status}')
-                # devmsg(f'member activity: {member.activity!r}')
-                # devmsg(f'member flags: {member.flags!r}')
-                # find() will create the char if it doesn't exist
-                tmp = self.characters.find(member)
-                # devmsg(f'char: {tmp!r}')
-                # devmsg(f"member status: '{member.status!r}' and online: {tmp.online}")
-                await self.set_player_roles(member)
-                # Don't bother checking if it's already right, just overwrite and save
-                online = 0 if member.raw_status == 'offline' else 1
-                tmp.online = online
-                self.characters.update(tmp)
+            await self.reconcile_guild(guild)
 
+        self.ready = True
+        for work in self.shard_work.values():
+            work.rolesync.set_roles(self.role_online, self.role_idle, self.role_dnd)
+            work.start()
+        self.outbox.start(self.gamechan)
         devmsg('Game starting!')
         self.lasttime = int(time.time())
         if not self.loop_started:
             self.bg_task = self.loop.create_task(self.mainloop())
 
 
+    async def reconcile_guild(self, guild):
+        """
+        Set everyone's online status in one go, creating characters as needed,
+        and leave their roles to be sorted out in the background by their shard
+        :param guild: Guild object
+        :return: None
+        """
+        members = [member for member in guild.members if member.id != self.user.id]
+        changed = await self.characters.reconcile(members)
+        devmsg(f"{guild.name}: {len(members)} members, {changed} changed status")
+        rolesync = self.shard(guild.shard_id).rolesync
+        for member in members:
+            rolesync.request(member)
+
+    def shard(self, shard_id):
+        """
+        Get a shard's queues, setting them up the first time
+        :param shard_id: Discord shard id
+        :return: shards.Shard
+        """
+        work = self.shard_work.get(shard_id)
+        if work is None:
+            work = shards.Shard(
+                shard_id, self.presence_batch, self.message_penalties,
+                presence_window=self.presence_window, penalty_window=self.penalty_window,
+                role_workers=self.role_workers,
+            )
+            self.shard_work[shard_id] = work
+            # Until on_ready, updates just queue up
+            if self.ready:
+                work.rolesync.set_roles(self.role_online, self.role_idle, self.role_dnd)
+                work.start()
+        return work
+
     async def scan_users(self, message):
         """Scan all members on the server and update status"""
         guild = message.guild
@@ -164,15 +282,11 @@ class IdleRPG(discord.Client):
         if message.author.id == self.user.id:
             return
         chan = message.channel
-        char = self.characters.find(message.author)
+        char = await self.characters.find(message.author)
         content = message.content
         # devmsg(f"char({char.username}) chan({chan.name}) message({message.content})")
         if chan.name == 'idlerpg':
-            devmsg(message)
-            devmsg(content)
-            pen = self.penalize(char, 'message', len(content))
-            dur = self.duration(pen)
-            await self.gamechan.send(f"Penalty of {dur} added to {char.username}'s timer for a message.")
+            self.shard(message.guild.shard_id).penalties.add(message.author, self.message_penalty(char, len(content)))
 
         elif chan.name == 'bot-commands':
             # devmsg('bot-commands channel entry')
@@ -190,15 +304,30 @@ class IdleRPG(discord.Client):
                 elif content == '!save':
                     await chan.send("Saving all characters...")
                     self.characters.updatedb()
+                    await self.db.barrier()
                     await chan.send("...all characters saved")
                     return
                 elif content == '!shutdown':
                     await chan.send("Saving all characters...")
                     self.characters.updatedb()
+                    await self.db.barrier()
+                    await self.outbox.drain()
                     await chan.send("Shutting down.")
                     self.running = False
+                    self.ticker.stop()
                     await self.close()
                     return
+                elif content == '!ticks':
+                    return await chan.send(f"Ticks: {self.ticker.stats()}")
+                elif content == '!db':
+                    return await chan.send(f"Database: {self.db.stats()}\nCold cache: {self.characters.cold.stats()}")
+                elif content == '!shards':
+                    latencies = dict(self.latencies)
+                    return await chan.send('\n'.join(
+                        work.stats(latencies.get(shard_id)) for shard_id, work in sorted(self.shard_work.items())
+                    ))
+                elif content == '!outbox':
+                    return await chan.send(f"Outbox: {self.outbox.stats()}")
                 elif content == '!godsend':
                     return await self.godsend()
                 elif content == '!calamity':
@@ -234,7 +363,7 @@ class IdleRPG(discord.Client):
                     # TODO: reset tournament if implemented and one is running
                     # TODO: clear team stats, once implemented
                     self.characters.zero()
-                    return await self.gamechan.send("** Game Reset! **")
+                    return self.outbox.send("** Game Reset! **")
 
             ###################
             # Member commands #
@@ -304,13 +433,8 @@ class IdleRPG(discord.Client):
         difference = abs(old_length - new_length)
         if difference == 0:
             difference = 1
-        char = self.characters.find(after.author)
-        pen = self.penalize(char, 'message', difference)
-        dur = self.duration(pen)
-        await self.gamechan.send(
-            f"Penalty of {dur} added to {char.username}'s "
-            "timer for editing a message."
-        )
+        char = await self.characters.find(after.author)
+        self.shard(after.guild.shard_id).penalties.add(after.author, self.message_penalty(char, difference), 'edit')
 
     # This could be helpful for message deletes eventually
     async def SKIPon_audit_log_entry_create(self, entry):
@@ -329,7 +453,7 @@ class IdleRPG(discord.Client):
             # devmsg(f"ended: author of deleted message ({message.author}) is us")
             return
         # Skip if the author isn't a player somehow
-        if self.characters.find(message.author) is None:
+        if await self.characters.find(message.author) is None:
             # devmsg(f'ended: author ({message.author}) is not playing')
             return
         # At this point, we need to check to see if a mod did the delete
@@ -342,50 +466,21 @@ class IdleRPG(discord.Client):
         length = len(message.content)
         # devmsg(f"message content: {message.content} with length {length}")
         character_id = message.author.id
-        char = self.characters.find(message.author)
+        char = await self.characters.find(message.author)
         pen = self.penalize(char, 'message', length)
         dur = self.duration(pen)
-        await self.gamechan.send(
+        self.outbox.send(
             f"Penalty of {dur} added to {char.username}'s "
             "timer for deleting a message."
         )
 
-    async def set_player_roles(self, member):
+    def set_player_roles(self, member):
         """
-        Set the player's roles correctly
+        Set the player's roles correctly, once their status has settled
         :param member: Member object
         :return: None
         """
-        if member.raw_status == 'idle':
-            await member.remove_roles(
-                self.role_online, self.role_dnd,
-                reason="IdleRPG Role Status Adjustment"
-            )
-            await member.add_roles(
-                self.role_idle,
-                reason="IdleRPG Role Status Adjustment")
-        elif member.raw_status == 'online':
-            await member.remove_roles(
-                self.role_idle, self.role_dnd,
-                reason="IdleRPG Role Status Adjustment"
-            )
-            await member.add_roles(
-                self.role_online,
-                reason="IdleRPG Role Status Adjustment")
-        elif member.raw_status == 'dnd':
-            await member.remove_roles(
-                self.role_idle, self.role_online,
-                reason="IdleRPG Role Status Adjustment"
-            )
-            await member.add_roles(
-                self.role_dnd,
-                reason="IdleRPG Role Status Adjustment")
-        else:
-            await member.remove_roles(
-                self.role_idle, self.role_online, self.role_dnd,
-                reason="IdleRPG Role Status Adjustment"
-            )
-
+        self.shard(member.guild.shard_id).rolesync.request(member, self.role_settle)
 
     async def on_reaction_add(self, reaction, user):
         devmsg(f'{user} added a reaction to {reaction.message}')
@@ -424,65 +519,94 @@ class IdleRPG(discord.Client):
         # TODO: Penalize
 
     async def on_presence_update(self, member_before, member_after):
-        name = member_before.global_name
-        if name is None:
-            name = member_before.name
-        char = self.characters.find(member_after)
-        username = char.username
-        # devmsg(f'char: {character!r}')
-        # devmsg(f'Member "{username}" updated presence')
-        await self.set_player_roles(member_after)
-        if member_before.raw_status != member_after.raw_status:
-            bef = member_before.raw_status
-            aft = member_after.raw_status
-            if bef == 'offline':
-                char.online = 1
-                self.characters.update(char)
-                level = char.level
-                charclass = char.charclass
-                guild = member_before.guild.name
-                heshe = char.heshe(uppercase=1)
-                dur = self.duration(char.next_ttl)
-                guild_name = guild.name
-                if guild_name == 'Open R P G':
-                    guild_name = 'OpenRPG'
-                await self.gamechan.send(
-                    f"{username}, the level {level} {charclass} "
-                    f"is now online from **{guild_name}**. "
-                    f"{heshe} reaches level {level + 1} in {dur}."
-                )
-            else:
-                if aft == 'offline':
-                    char.online = 0
-                    pen = self.penalize(char, 'status')
-                    self.characters.update(char)
-                    dur = self.duration(pen)
-                    await self.gamechan.send(
-                        f"Penalty of {dur} added to {username}'s "
-                        "timer for going offline."
-                    )
+        self.shard(member_after.guild.shard_id).presence.put(member_before, member_after)
 
-        if member_before.activity is not None and member_after.activity is not None and member_before.activity.name != member_after.activity.name:
-            bef = member_before.activity
-            aft = member_after.activity
-            devmsg(f'before activity: {bef!r}')
-            devmsg(f'after  activity: {aft!r}')
-            pen = self.penalize(char, 'activity')
-            self.characters.update(char)
-            dur = self.duration(pen)
-            devmsg(f"pen({pen}) dur({dur})")
-
-            # f"Penalty of {dur} added to {username}'s timer
-            # for activity change of '{bef}' to '{aft}'."
-            # Before is an ActivityType.watching
-            # After can be 'None'
-            await self.gamechan.send(
-                f"Penalty of {dur} added to {username}'s "
-                "timer for activity change."
+    async def presence_batch(self, updates):
+        """
+        Handle a batch of presence updates, each member's coalesced into one.
+        Characters are written in one go and the announcements summed up if there are many.
+        :param updates: list of (before, after) Member object pairs
+        :return: None
+        """
+        try:
+            await self.characters.preload([after.id for before, after in updates])
+        except Exception as e:
+            # find() loads them one at a time instead
+            devmsg(f"Exception: {e}")
+            traceback.print_exc()
+        came_online = []
+        went_offline = []
+        changed_activity = []
+        with self.characters.batch():
+            for member_before, member_after in updates:
+                # One member going wrong mustn't lose everyone else's updates
+                try:
+                    char = await self.characters.find(member_after)
+                    self.set_player_roles(member_after)
+                    bef = member_before.raw_status
+                    aft = member_after.raw_status
+                    if bef != aft:
+                        if bef == 'offline':
+                            char.online = 1
+                            self.characters.update(char)
+                            came_online.append((char, member_after))
+                        elif aft == 'offline':
+                            char.online = 0
+                            pen = self.penalize(char, 'status')
+                            went_offline.append((char, pen))
+
+                    if member_before.activity is not None and member_after.activity is not None and member_before.activity.name != member_after.activity.name:
+                        # Before is an ActivityType.watching
+                        # After can be 'None'
+                        pen = self.penalize(char, 'activity')
+                        changed_activity.append((char, pen))
+                except Exception as e:
+                    devmsg(f"Exception handling presence of {member_after.id}: {e}")
+                    traceback.print_exc()
+
+        self.announce_online(came_online)
+        self.announce_penalties(went_offline, "going offline")
+        self.announce_penalties(changed_activity, "activity change")
+
+    def announce_online(self, arrivals):
+        """
+        Announce players coming online
+        :param arrivals: list of (Character object, Member object)
+        :return: None
+        """
+        if len(arrivals) > self.announce_limit:
+            names = ', '.join(char.username for char, member in arrivals)
+            self.outbox.send(f"{len(arrivals)} players are now online: {names}.")
+            return
+        for char, member in arrivals:
+            level = char.level
+            heshe = char.heshe(uppercase=1)
+            dur = self.duration(char.next_ttl)
+            guild_name = member.guild.name
+            if guild_name == 'Open R P G':
+                guild_name = 'OpenRPG'
+            self.outbox.send(
+                f"{char.username}, the level {level} {char.charclass} "
+                f"is now online from **{guild_name}**. "
+                f"{heshe} reaches level {level + 1} in {dur}."
             )
 
-        if char.online == 0:
+    def announce_penalties(self, penalties, reason):
+        """
+        Announce penalties of one kind
+        :param penalties: list of (Character object, seconds penalized)
+        :param reason: what they were penalized for
+        :return: None
+        """
+        if len(penalties) > self.announce_limit:
+            each = ', '.join(f"{char.username} ({self.duration(pen)})" for char, pen in penalties)
+            self.outbox.send(f"Penalties added for {reason}: {each}.")
             return
+        for char, pen in penalties:
+            self.outbox.send(
+                f"Penalty of {self.duration(pen)} added to {char.username}'s "
+                f"timer for {reason}."
+            )
 
     async def on_connect(self):
         devmsg('connected')
@@ -490,11 +614,30 @@ class IdleRPG(discord.Client):
     async def on_disconnect(self):
         devmsg('disconnected')
 
-    async def on_shard_connect(self):
-        devmsg('shard connected')
-
-    async def on_shard_disconnect(self):
-        devmsg('shard disconnected')
+    async def on_shard_connect(self, shard_id):
+        devmsg(f'shard {shard_id} connected')
+        self.shard(shard_id).connect()
+
+    async def on_shard_disconnect(self, shard_id):
+        devmsg(f'shard {shard_id} disconnected')
+        self.shard(shard_id).disconnect()
+
+    async def on_shard_resumed(self, shard_id):
+        devmsg(f'shard {shard_id} resumed')
+        work = self.shard(shard_id)
+        work.resumes += 1
+        work.connected = True
+
+    async def on_shard_ready(self, shard_id):
+        devmsg(f'shard {shard_id} ready')
+        work = self.shard(shard_id)
+        work.readies += 1
+        # A shard that had to start a new session missed its presence updates while it was
+        # away, so catch its guilds up. The first time round on_ready does all of them.
+        if self.ready:
+            for guild in self.guilds:
+                if guild.shard_id == shard_id:
+                    await self.reconcile_guild(guild)
 
     async def on_resumed(self):
         devmsg('resumed')
@@ -508,25 +651,33 @@ class IdleRPG(discord.Client):
 
     async def mainloop(self):
         """
-        This is the function that keeps us moving
+        This is the function that keeps us moving. Ticks every self_clock seconds, or up to
+        max_clock seconds when busy, until shut down.
         :return: None
         """
         # devmsg('start')
         self.loop_started = True
-        try:
-            await self.rpcheck()
-        except Exception as e:
-            devmsg(f"Exception: {e}")
+        await self.ticker.run()
+        await self.save_all()
+        devmsg('ended')
+        exit(0)
 
-        # Wait self_clock seconds and start mainloop() over
-        # devmsg('sleeping')
-        await asyncio.sleep(self.self_clock)
-        # devmsg('creating task')
-        if self.running:
-            self.bg_task = self.loop.create_task(self.mainloop())
-        else:
-            devmsg('ended')
-            exit(0)
+    async def tick(self):
+        """
+        Everything that happens once per self_clock seconds
+        :return: None
+        """
+        await self.rpcheck()
+
+        # Pick up any edits to monsters.txt or events.txt
+        self.content.refresh()
+
+        # Write out changed characters every flush_interval seconds. If the database
+        # is behind, hold off and let the changes build up into a bigger batch.
+        now = time.time()
+        if now - self.lastflush >= self.flush_interval and not self.db.busy():
+            self.characters.flush()
+            self.lastflush = now
 
     async def rpcheck(self):
         """
@@ -535,49 +686,31 @@ class IdleRPG(discord.Client):
         :return: None
         """
         # devmsg('start')
-        self_clock = self.self_clock  # avoid tons of lookups
-        # Get a list of online users
-        online = self.characters.online()
-        online_good = self.characters.online(alignment='g')
-        online_evil = self.characters.online(alignment='e')
-        # devmsg('got char lists')
-
-        online_count = len(online)
+        # Count online users
+        online_count = self.characters.online_count()
+        # devmsg('got char counts')
+
         # If nobody is online, we have nothing to do
         if online_count == 0:
             devmsg('ended: nobody online')
             return
-        # devmsg('checking randoms for general events')
-        if randint(0, int(24 * 86400 / self_clock)) < online_count:
-            await self.monster_hunt()
-        if randint(0, int(20 * 86400 / self_clock)) < online_count:
-            await self.hand_of_god()
-        if randint(0, int(9  * 86400 / self_clock)) < online_count:
-            await self.group_battle()
-        if randint(0, int(9  * 86400 / self_clock)) < online_count:
-            await self.team_battle()
-        if randint(0, int(8  * 86400 / self_clock)) < online_count:
-            await self.calamity()
-        if randint(0, int(8  * 86400 / self_clock)) < online_count:
-            await self.godsend()
-        if randint(0, int(8  * 14400 / self_clock)) < online_count:
-            await self.celebrity_fight()
-        if randint(0, int(8  * 19400 / self_clock)) < online_count:
-            await self.random_gold()
-        if randint(0, int(8  * 43200 / self_clock)) < online_count:
-            await self.monster_attack()
-
-        # Do the following if at least 15% of the characters are online
-        # devmsg('checking randoms for good/evil events')
-        if online_count / len(self.characters.chars) > .15:
-            if randint(0, int(8  * 86400 / self_clock)) < len(online_good):
-                await self.random_steal()
-            if randint(0, int(12 * 86400 / self_clock)) < len(online_evil):
-                await self.evilness()
-            if randint(0, int(12 * 86400 / self_clock)) < len(online_good):
-                await self.goodness()
-            if randint(0, int(20 * 86400 / self_clock)) < len(online_good):
-                await self.godsend()
+
+        # Fire whichever random events are due. Good/evil events only happen
+        # if at least 15% of the characters are online. Flavor events are skipped
+        # while ticks are overloaded; level-ups and penalties always run.
+        # devmsg('checking random events')
+        now = time.time()
+        populations = {'online': online_count, 'good': 0, 'evil': 0}
+        if online_count / self.characters.total > .15:
+            populations['good'] = self.characters.online_count(alignment='g')
+            populations['evil'] = self.characters.online_count(alignment='e')
+        self.events.update(populations, now)
+        overloaded = self.ticker.overloaded()
+        for event, sheddable in self.events.pop_due(now):
+            if sheddable and overloaded:
+                self.ticker.shed += 1
+                continue
+            await event()
 
         # Always do the following
         await self.moveplayers()
@@ -589,6 +722,11 @@ class IdleRPG(discord.Client):
         # Hourly Tasks  (TODO: fact check 'Hourly')
         if self.rpreport and (self.rpreport % 3600 < self.oldrpreport % 3600):
             devmsg('doing hourly tasks')
+            devmsg(f"outbox: {self.outbox.stats()}")
+            devmsg(f"ticks: {self.ticker.stats()}")
+            devmsg(f"database: {self.db.stats()}")
+            # Save a snapshot for a quick restart
+            await self.characters.checkpoint()
             # Reseed random
             seed()
             # Show the Top 5 idlers
@@ -597,51 +735,60 @@ class IdleRPG(discord.Client):
             # TODO: await self.announce_next_tournament()
 
             # TODO: random_challenge, hourly, 15% of all players must be level 25+ irpg.pl:2643
-            players = self.characters.online(levelplus=25)
+            players = self.characters.online_count(levelplus=25)
             # 15% of online players must be level 25+
-            if len(players) / len(online) > .15:
+            if players / online_count > .15:
                 char = self.random_online_char()
                 await self.random_challenge(char)
 
-        # Decrement next_ttl, level up, etc
+        # Move the clock on, level up whoever is due, etc. The clock stays put
+        # while we yield between chunks, so everyone sees the same time.
         # devmsg('doing instant tasks')
         curtime = int(time.time())
-        for char_id in self.characters.online():
-            char = self.characters.chars[char_id]
-            # devmsg(f'processing char {char}')
-            delta = curtime - self.lasttime
-            char.next_ttl -= delta
-            char.idled += delta
-            # devmsg(f"{char.username} ttl is {char.next_ttl}")
-            if char.next_ttl < 1:
-                devmsg(f"{char.username} leveled...")
-                nextlevel = char.level + 1
-                base_ttl = self.base_ttl(nextlevel)
-                devmsg(f"got new ttl of {base_ttl}")
-                char.level += 1
-                char.next_ttl = base_ttl
-                nextlevel += 1
-                char.popcorn = 0
-                char.regentime = 0
-                char.challengetime = 0
-                char.slaytime = 0
-                if char.level < 200:
-                    char.ffight = 0
-                char.bets = 0
-                char.pot = 0
-                devmsg('updated char in db')
-                heshe = char.heshe(uppercase=1)
-                devmsg(f"heshe: {heshe}")
-                dur = self.duration(base_ttl)
-                await self.gamechan.send(
-                    f"{char.username}, {char.charclass}, has attained level {char.level}! "
-                    f"{heshe} reaches level {nextlevel} in {dur}."
-                )
-                await self.find_item(char)
-                await self.find_gold(char)
-                await self.random_challenge(char)
-                await self.monster_attack_player(char)
-            self.characters.update(char)
+        due = self.characters.tick(curtime)
+        done = 0
+        try:
+            async for char in scheduler.cooperative(due, self.tick_chunk, self.tick_slice):
+                # devmsg(f'processing char {char}')
+                # devmsg(f"{char.username} ttl is {char.next_ttl}")
+                if not char.online:
+                    # Went offline while we let the loop run; their frozen next_ttl can still be < 1
+                    done += 1
+                    continue
+                if char.next_ttl < 1:
+                    devmsg(f"{char.username} leveled...")
+                    nextlevel = char.level + 1
+                    base_ttl = self.base_ttl(nextlevel)
+                    devmsg(f"got new ttl of {base_ttl}")
+                    char.level += 1
+                    char.next_ttl = base_ttl
+                    nextlevel += 1
+                    char.popcorn = 0
+                    char.regentime = 0
+                    char.challengetime = 0
+                    char.slaytime = 0
+                    if char.level < 200:
+                        char.ffight = 0
+                    char.bets = 0
+                    char.pot = 0
+                    devmsg('updated char in db')
+                    heshe = char.heshe(uppercase=1)
+                    devmsg(f"heshe: {heshe}")
+                    dur = self.duration(base_ttl)
+                    self.outbox.send(
+                        f"{char.username}, {char.charclass}, has attained level {char.level}! "
+                        f"{heshe} reaches level {nextlevel} in {dur}."
+                    )
+                    await self.find_item(char)
+                    await self.find_gold(char)
+                    await self.random_challenge(char)
+                    await self.monster_attack_player(char)
+                    self.characters.update(char)
+                done += 1
+        except BaseException:
+            # Whoever we didn't get to comes up again next tick, as if they'd never been popped
+            self.characters.requeue(due[done:])
+            raise
 
         # self.characters.updatedb()
         self.oldrpreport = self.rpreport
@@ -657,10 +804,7 @@ class IdleRPG(discord.Client):
         Pick a random online character
         :return: char
         """
-        players = self.characters.online()
-        if players is None:
-            return
-        return self.characters.chars[choice(players)]
+        return self.characters.random_online()
 
     async def monster_attack(self) -> None:
         """
@@ -707,32 +851,23 @@ class IdleRPG(discord.Client):
             char.fightwon(gain)
             dur = self.duration(gain)
             nextlevel = self.nextlevel(char)
-            await self.gamechan.send(f"{output} and won! {dur} is removed from {char.username}'s clock. {nextlevel}")
+            self.outbox.send(f"{output} and won! {dur} is removed from {char.username}'s clock. {nextlevel}")
         else:
             loss = int(loss * char.next_ttl / 100)
             char.fightlost(loss)
             dur = self.duration(loss)
             nextlevel = self.nextlevel(char)
-            await self.gamechan.send(f"{output} and lost! {dur} is added to {char.username}'s clock. {nextlevel}")
+            self.outbox.send(f"{output} and lost! {dur} is added to {char.username}'s clock. {nextlevel}")
         self.characters.update(char)
         devmsg('ended')
 
-    @staticmethod
-    def get_monster_name(target_monster_sum):
+    def get_monster_name(self, target_monster_sum):
         """
         Get an appropriate monster name for the sum provided
         :param target_monster_sum: monster sum
         :return: monster name
         """
-        monster_name = "Monster"
-        mfile = open('monsters.txt', 'r')
-        while True:
-            mline = mfile.readline().rstrip()
-            monster_sum, monster_name = mline.split(None, 1)
-            if int(monster_sum) >= target_monster_sum:
-                mfile.close()
-                break
-        return monster_name
+        return self.content.monster_name(target_monster_sum)
 
     async def random_challenge(self, char1) -> None:
         """
@@ -746,10 +881,10 @@ class IdleRPG(discord.Client):
         itemsum = char1.itemsum()
         min_sum   = itemsum * 0.85
         max_sum   = itemsum * 1.15
-        opponents = self.characters.filter(online=1, levelminus=max_level, charsumplus=min_sum,
-                                           charsumminus=max_sum, notnamed=char1.username)
+        opponents = self.characters.opponents(char1, levelminus=max_level, charsumplus=min_sum,
+                                              charsumminus=max_sum)
         if len(opponents) == 0:
-            await self.gamechan.send(f"{char1.username} issued a challenge, but nobody felt like being defeated.")
+            self.outbox.send(f"{char1.username} issued a challenge, but nobody felt like being defeated.")
             return
 
         char2 = self.characters.chars[choice(opponents)]
@@ -767,7 +902,7 @@ class IdleRPG(discord.Client):
             char1.fightwon(gain)  # ttl gain, battles won incremented
             char2.fightlost(0)  # they don't get penalized, but battles lost incremented
             nl = self.nextlevel(char1)
-            await self.gamechan.send(f"{output} and won! {dur} is removed from {char1name}'s clock. {nl}")
+            self.outbox.send(f"{output} and won! {dur} is removed from {char1name}'s clock. {nl}")
             if char1sum > 0 and char2sum > 0 and char1roll / char1sum >= .85 and char2roll / char2sum <= .15:
                 # Try critical strike
                 dice = await self.try_critical_strike(char1, char2)
@@ -782,7 +917,7 @@ class IdleRPG(discord.Client):
             char1.fightlost(gain)
             char2.fightwon(0)
             nl = self.nextlevel(char1)
-            await self.gamechan.send(f"{output} and lost! {dur} is added to {char1name}'s clock. {nl}")
+            self.outbox.send(f"{output} and lost! {dur} is added to {char1name}'s clock. {nl}")
 
         self.characters.update(char1)
         self.characters.update(char2)
@@ -794,7 +929,7 @@ class IdleRPG(discord.Client):
         char.gold += gold_amount
         self.characters.update(char)
         gold_total = char.gold
-        await self.gamechan.send(
+        self.outbox.send(
             f"{char.username} found {gold_amount} gold pieces lying on the "
             f"ground and picked them up to sum {gold_total} total gold."
         )
@@ -830,7 +965,7 @@ class IdleRPG(discord.Client):
             curr_item = self.format_named_item(curr_level, item_type)
             new_item = self.format_named_item(item_level, item_type)
             output = f"{char.username} found a {new_item}"
-            if self.item_level(item_level) > self.item_level(curr_level):
+            if self.item_level(item_level) > char.item_level(item_type):
                 # It is better
                 devmsg('it is better')
                 output += f"! {HisHer} current {item_type} was level {curr_level}, so it seems Luck is with {himher}!"
@@ -845,7 +980,7 @@ class IdleRPG(discord.Client):
                 output += f", but it wasn't better than {hisher} {curr_item}. {action}"
                 # TODO: engineer_item: irpg.pl:3440
                 self.drop_item(char, item_type, item_level)  # TODO: unless engineer!!
-            await self.gamechan.send(output)
+            self.outbox.send(output)
         else:
             # Unique item
             # TODO: unique items, irpg.pl:3445
@@ -856,9 +991,7 @@ class IdleRPG(discord.Client):
 
     @staticmethod
     def random_item():
-        item_type = choice(
-            ['ring', 'amulet', 'charm', 'weapon', 'helm', 'tunic', 'gloves', 'legs', 'shield', 'boots']
-        )
+        item_type = choice(character.ITEMS)
         return item_type
 
     def drop_item(self, char, item_type: str, item_level: str):
@@ -906,30 +1039,9 @@ class IdleRPG(discord.Client):
         """
         Split prefix, level, and suffix from raw item string
         :param item: string, item description
-        :return: list of 1 char, 1 integer, 1 char
-        """
-        prefix = ''
-        level = ''
-        suffix = ''
-        digits = '0123456789'
-        alphas = 'abcdefghijklmnopqrstuvwxyz'
-        stage = 0  # 0: prefix, 1: level, 2: suffix
-        for x in item:
-            if stage == 0 and x in alphas:
-                prefix = x
-                stage = 1
-                continue
-            elif stage == 0 and x in digits:
-                level += x
-                stage = 1
-                continue
-            elif stage == 1 and x in digits:
-                level += x
-                continue
-            elif stage == 1 and x in alphas:
-                suffix = x
-                stage = 2
-        return [prefix, level, suffix]
+        :return: tuple of 1 char, 1 integer, 1 char
+        """
+        return character.parse_item(str(item))
 
     @staticmethod
     def item_level(item: str) -> int:
@@ -938,12 +1050,7 @@ class IdleRPG(discord.Client):
         :param item: item string
         :return: integer level
         """
-        devmsg('start')
-        return int(
-            item.translate(
-                {ord(letter): None for letter in 'abcdefghijklmnopqrstuvwxyz'}
-            )
-        )
+        return character.parse_item(str(item))[1]
 
     def get_unique_item(self, level: int) -> str:
         devmsg('start')
@@ -962,11 +1069,11 @@ class IdleRPG(discord.Client):
         return int(self.rpbase * (math.pow(self.rpstep, 60)) + (86400 * (level - 60)))
 
     async def announce_next_tournament(self):
-        await self.gamechan.send("TODO: Announce Next Tournament!")
+        self.outbox.send("TODO: Announce Next Tournament!")
 
     async def process_items(self):
         # devmsg('start')
-        # await self.gamechan.send(f"TODO: Random Steal!")
+        # self.outbox.send(f"TODO: Random Steal!")
         # devmsg('ended')
         pass
 
@@ -974,42 +1081,15 @@ class IdleRPG(discord.Client):
         # devmsg('start')
         if self.lasttime <= 1:
             return
-        online_player_ids = self.characters.online()
-        online_count = len(online_player_ids)
-        if online_count == 0:
-            return
-        positions = {}  # nested dict to hold player positions to detect collisions
         # TODO: implement quest type 2
-        for player_id in online_player_ids:
-            char = self.characters.chars[player_id]
-            # devmsg(f'moving player {char.username}')
-            char.x_pos += randint(-1, 1)  # -1, 0, or 1
-            char.y_pos += randint(-1, 1)  # So doesn't move, or just 1 spot in any direction
-            if char.x_pos > self.mapx:
-                char.x_pos -= self.mapx
-            if char.y_pos > self.mapy:
-                char.y_pos -= self.mapy
-            if char.x_pos < 0:
-                char.x_pos += self.mapx
-            if char.y_pos < 0:
-                char.y_pos += self.mapy
-            self.characters.update(char)
-            # Here we implement collisions between players using nested dicts
-            x = char.x_pos
-            y = char.y_pos
-            if x not in positions:
-                positions[x] = {y: {'c': char, 'b': False}}  # c: character ref, b: indicate if battle happened
-            else:
-                if y not in positions[x]:
-                    positions[x][y] = {'c': char, 'b': False}
-                else:
-                    if positions[x][y]['b'] is False:
-                        # collision
-                        devmsg(f"collide: {char.username}, {positions[x][y]['c'].username}")
-                        positions[x][y]['b'] = True
-                        await self.collision_fight(char, positions[x][y]['c'])
+        collisions = self.characters.move(self.mapx, self.mapy)
+        async for char1, char2 in scheduler.cooperative(collisions, self.tick_chunk, self.tick_slice):
+            if not char1.online or not char2.online:
+                continue  # One of them left while we let the loop run
+            devmsg(f"collide: {char1.username}, {char2.username}")
+            await self.collision_fight(char1, char2)
 
-            # TODO: pick up items lying around irpg.pl#3697
+        # TODO: pick up items lying around irpg.pl#3697
 
         # devmsg('ended')
 
@@ -1049,7 +1129,7 @@ class IdleRPG(discord.Client):
                     output_text += " and gave 'em what was coming!"
             nl = self.nextlevel(char1)
             output_text += f"\n{dur} is removed from {char1.username}'s clock. {nl}"
-            await self.gamechan.send(output_text)
+            self.outbox.send(output_text)
             # Critical Strike chance if p1 rolled 85+% of max and p2 rolled 15-% theirs
             if p1sum > 0 and p2sum > 0 and p1roll / p1sum >= .85 and p2roll / p2sum <= .15:
                 dice = await self.try_critical_strike(char1, char2)
@@ -1077,7 +1157,7 @@ class IdleRPG(discord.Client):
                     output_text += " and didn't wake up till the next morning!"
             nl = self.nextlevel(char1)
             output_text += f"\n{dur} is added to {char1.username}'s clock. {nl}"
-            await self.gamechan.send(output_text)
+            self.outbox.send(output_text)
             # Critical Strike chance if p2 rolled 85+% of max and p1 rolled 15-% theirs
             if p1sum > 0 and p2sum > 0 and p1roll / p1sum <= .15 and p2roll / p2sum >= .85:
                 dice = await self.try_critical_strike(char2, char1)
@@ -1110,7 +1190,7 @@ class IdleRPG(discord.Client):
             c2 = char2.username
             dur = self.duration(gain)
             c2nl = self.nextlevel(char2)
-            await self.gamechan.send(
+            self.outbox.send(
                 f"{c1} has dealt {c2} a Critical Strike! {dur} is added to {c2}'s clock. {c2nl}"
             )
             self.characters.update(char2)
@@ -1139,14 +1219,14 @@ class IdleRPG(discord.Client):
 
         if randint(1, randbase) == 1:
             itype = self.random_item()  # item type
-            c1il = self.item_level(char1.get_item(itype))  # character 1 item level
-            c2il = self.item_level(char2.get_item(itype))  # character 2 item level
+            c1il = char1.item_level(itype)  # character 1 item level
+            c2il = char2.item_level(itype)  # character 2 item level
             if c2il > c1il:  # if character 2 item level > character 1 item level
                 c1hh = char1.hisher()
                 c2hh = char2.hisher()
                 c1n = char1.username
                 c2n = char2.username
-                await self.gamechan.send(
+                self.outbox.send(
                     f"In the fierce battle, {c2n} dropped {c2hh} level {c2il} {itype}! "
                     f"{c1n} picks it up, tossing {c1hh} old level {c1il} {itype} to {c2n}."
                 )
@@ -1215,17 +1295,17 @@ class IdleRPG(discord.Client):
 
     async def goodness(self):
         devmsg('start')
-        await self.gamechan.send(f"TODO: Random Goodness!")
+        self.outbox.send(f"TODO: Random Goodness!")
         devmsg('ended')
 
     async def evilness(self):
         devmsg('start')
-        await self.gamechan.send(f"TODO: Random Evilness!")
+        self.outbox.send(f"TODO: Random Evilness!")
         devmsg('ended')
 
     async def random_steal(self):
         devmsg('start')
-        await self.gamechan.send(f"TODO: Random Steal!")
+        self.outbox.send(f"TODO: Random Steal!")
         devmsg('ended')
 
     async def random_gold(self):
@@ -1236,7 +1316,7 @@ class IdleRPG(discord.Client):
         gold_amount = randint(0, char.level) + 10
         gold = char.addgold(gold_amount)
         self.characters.update(char)
-        await self.gamechan.send(
+        self.outbox.send(
             f"{char.username} just walked by {gold_amount} gold pieces and picked them up to sum {gold} total gold."
         )
         devmsg('ended')
@@ -1250,44 +1330,7 @@ class IdleRPG(discord.Client):
         char = self.random_online_char()
         if char is None:
             return
-        celebs = {
-            'Humpty Dumpty'         :  0,
-            'Tweedledee'            :  0,
-            'Tweedledum'            :  0,
-            'Cheshire Cat'          :  1,
-            'Oompa Loompa'          :  1,
-            'Bilbo Baggins'         :  2,
-            'Hermione Granger'      :  2,
-            'Princess Buttercup'    :  2,
-            'Frodo Baggins'         :  3,
-            'Samwise Gamgee'        :  3,
-            'Gollum'                :  4,
-            'Circe'                 :  4,
-            'Robin Hood'            :  5,
-            'Harry Potter'          :  5,
-            'Shrek'                 :  6,
-            'Princess Fiona'        :  6,
-            'Conan'                 :  7,
-            'Harry Dresden'         :  7,
-            'Captain Jack Sparrow'  :  7,
-            'Medusa'                :  8,
-            'King Arthur'           :  8,
-            'Joan of Arc'           :  8,
-            'Merlin'                :  9,
-            'Richard Rahl'          :  9,
-            'Van Helsing'           :  9,
-            'Saruman'               : 10,
-            'Belgarath'             : 10,
-            'Dread Pirate Roberts'  : 10,
-            'Severus Snape'         : 11,
-            "Zeddicus Zu'l Zorander": 11,
-            'Albus Dumbledore'      : 12,
-            'Lord Voldemort'        : 13,
-            'Gandalf the Grey'      : 15,
-            'Elminster'             : 15,
-        }
-        celeb = choice(list(celebs.keys()))
-        clevel = celebs[celeb]
+        celeb, clevel = self.content.celebrity()
         devmsg(f"player({char}) celeb({celeb}) clevel({clevel})")
         oppsum = 150 * (clevel + 1)
         (p1roll, p1sum, p1showsum, p1showtxt) = self.display_sums(char, align=True, hero=False, pots=False)
@@ -1300,13 +1343,13 @@ class IdleRPG(discord.Client):
             char.fightwon(gain)
             char.addgold(10)
             nextlevel = self.nextlevel(char)
-            await self.gamechan.send(
+            self.outbox.send(
                 f"{output} wins! {dur} removed from {char.username}'s time and 10 gold added. {nextlevel}"
             )
         else:
             char.fightlost(gain)
             nextlevel = self.nextlevel(char)
-            await self.gamechan.send(f"{output} lost! {dur} added to {char.username}'s time. {nextlevel}")
+            self.outbox.send(f"{output} lost! {dur} added to {char.username}'s time. {nextlevel}")
         self.characters.update(char)
         devmsg('ended')
 
@@ -1352,34 +1395,19 @@ class IdleRPG(discord.Client):
                 output = f"{name} stepped in some unicorn poo. It was gross to clean up, " \
                          f"but the boots are now 10% more effective."
 
-            rawitem = char.get_item(type)
-            prefix, level, suffix = self.item_parse(rawitem)
-            newlevel = int(float(level) * 1.1)
+            prefix, level, suffix = char.parsed_items()[type]
+            newlevel = int(level * 1.1)
             char.set_item(type, f"{prefix}{newlevel}{suffix}")
-            await self.gamechan.send(output)
+            self.outbox.send(output)
 
         else:
             bonus = int(randint(4, 12) / 100 * char.next_ttl)
-            # TODO: pull line from events file
             char.addttl(bonus * -1)
             dur = self.duration(bonus)
             nextlevel = self.nextlevel(char)
             nl = char.level + 1
-            action = "GENERIC_ACTION"
-            efile = open('events.txt', 'r')
-            index = 0
-            while True:
-                eline = efile.readline().rstrip()
-                if eline == "":
-                    efile.close()
-                    break
-                e_type, flavor = eline.split(None, 1)
-                if e_type == "G":
-                    index += 1
-                    random_number = uniform(0, index)
-                    if random_number < 1:
-                        action = flavor
-            await self.gamechan.send(f"{name} {action}. This wondrous godsend has "
+            action = self.content.event('G', "GENERIC_ACTION")
+            self.outbox.send(f"{name} {action}. This wondrous godsend has "
                                      f"accelerated them {dur} towards level {nl}. {nextlevel}")
 
         self.characters.update(char)
@@ -1433,35 +1461,20 @@ class IdleRPG(discord.Client):
                 output = f"{name} stepped on a really sharp rusty nail. " \
                          f"{HisHer} boots lost 10% of their effectiveness."
 
-            rawitem = char.get_item(type)
-            prefix, level, suffix = self.item_parse(rawitem)
-            newlevel = int(float(level) * 0.9)
+            prefix, level, suffix = char.parsed_items()[type]
+            newlevel = int(level * 0.9)
             char.set_item(type, f"{prefix}{newlevel}{suffix}")
-            await self.gamechan.send(output)
+            self.outbox.send(output)
 
         else:
             penalty = int(randint(4, 12) / 100 * char.next_ttl)
-            # TODO: pull line from events file
             char.addttl(penalty)
             dur = self.duration(penalty)
             nextlevel = self.nextlevel(char)
             nl = char.level + 1
-            action = "GENERIC_CALAMITY"
-            efile = open('events.txt', 'r')
-            index = 0
-            while True:
-                eline = efile.readline().rstrip()
-                if eline == "":
-                    efile.close()
-                    break
-                e_type, flavor = eline.split(None, 1)
-                if e_type == "C":
-                    index += 1
-                    random_number = uniform(0, index)
-                    if random_number < 1:
-                        action = flavor
-
-            await self.gamechan.send(
+            action = self.content.event('C', "GENERIC_CALAMITY")
+
+            self.outbox.send(
                 f"{name} {action}. This terrible calamity has slowed them {dur} from level {nl}. {nextlevel}"
             )
 
@@ -1471,17 +1484,17 @@ class IdleRPG(discord.Client):
 
     async def team_battle(self):
         devmsg('start')
-        await self.gamechan.send(f"TODO: Team Battle!")
+        self.outbox.send(f"TODO: Team Battle!")
         devmsg('ended')
 
     async def group_battle(self):
         devmsg('start')
-        await self.gamechan.send(f"TODO: Group Battle!")
+        self.outbox.send(f"TODO: Group Battle!")
         devmsg('ended')
 
     async def hand_of_god(self):
         devmsg('start')
-        # await self.gamechan.send(f"TODO: Hand of God!")
+        # self.outbox.send(f"TODO: Hand of God!")
         char = self.random_online_char()
         if char is None:
             return
@@ -1492,12 +1505,12 @@ class IdleRPG(discord.Client):
         if win:
             char.next_ttl -= bonus
             nextlevel = self.nextlevel(char)
-            await self.gamechan.send(f"Verily I say unto thee, the Heavens have burst forth, and the "
+            self.outbox.send(f"Verily I say unto thee, the Heavens have burst forth, and the "
                                      f"blessed hand of God carried {char.username} {dur} forward. {nextlevel}")
         else:
             char.next_ttl += bonus
             nextlevel = self.nextlevel(char)
-            await self.gamechan.send(f"Thereupon He stretched out His little finger among them and consumed "
+            self.outbox.send(f"Thereupon He stretched out His little finger among them and consumed "
                                      f"{char.username} with fire, slowing the heathen by {dur}. {nextlevel}")
         self.characters.update(char)
         devmsg('ended')
@@ -1509,7 +1522,7 @@ class IdleRPG(discord.Client):
 
     async def monster_hunt(self):
         devmsg('start')
-        await self.gamechan.send(f"TODO: Monster Hunt!")
+        self.outbox.send(f"TODO: Monster Hunt!")
         devmsg('ended')
 
     async def topx(self, count=5):
@@ -1522,7 +1535,7 @@ class IdleRPG(discord.Client):
             charclass = char.charclass
             lines.append(f"{char.username}, the level {level} {charclass}, is #{x}! Next level in {dur}.")
             x += 1
-        await self.gamechan.send('\n'.join(lines))
+        self.outbox.send('\n'.join(lines))
 
     def penalize(self, char, pen_type: str, *args) -> int:
         """
@@ -1545,11 +1558,7 @@ class IdleRPG(discord.Client):
             self.characters.update(char)
             return pen
         elif pen_type == "message":
-            length = args[0]
-            penalty_ttl = math.pow(self.rppenstep, char.level)
-            pen = int(length * penalty_ttl)
-            if pen > self.limitpen:
-                pen = self.limitpen
+            pen = self.message_penalty(char, args[0])
             char.pen_msg += pen
             char.next_ttl += pen
             self.characters.update(char)
@@ -1558,6 +1567,56 @@ class IdleRPG(discord.Client):
             devmsg(f"{char.username} gets an unhandled '{pen_type}' penalty")
             return 600
 
+    def message_penalty(self, char, length: int) -> int:
+        """
+        Work out the penalty for one message, without applying it
+        :param char: Character object
+        :param length: length of the message, or how much of it changed
+        :return: count of seconds to penalize
+        """
+        penalty_ttl = math.pow(self.rppenstep, char.level)
+        pen = int(length * penalty_ttl)
+        if pen > self.limitpen:
+            pen = self.limitpen
+        return pen
+
+    async def message_penalties(self, batch):
+        """
+        Apply message penalties totalled up by a shard, in one write with one announcement per kind
+        :param batch: list of (Member object, kind, seconds, count of messages)
+        :return: None
+        """
+        try:
+            await self.characters.preload([member.id for member, kind, pen, count in batch])
+        except Exception as e:
+            # find() loads them one at a time instead
+            devmsg(f"Exception: {e}")
+            traceback.print_exc()
+        penalized = {}  # Dict of kind to list of (Character object, seconds, count of messages)
+        with self.characters.batch():
+            for member, kind, pen, count in batch:
+                # One member going wrong mustn't lose everyone else's penalties
+                try:
+                    char = await self.characters.find(member)
+                    char.pen_msg += pen
+                    char.next_ttl += pen
+                    self.characters.update(char)
+                    penalized.setdefault(kind, []).append((char, pen, count))
+                except Exception as e:
+                    devmsg(f"Exception penalizing {member.id}: {e}")
+                    traceback.print_exc()
+        for kind, entries in penalized.items():
+            one, several, summary = self.message_reasons[kind]
+            if len(entries) == 1:
+                char, pen, count = entries[0]
+                what = one if count == 1 else several.format(count)
+                self.outbox.send(f"Penalty of {self.duration(pen)} added to {char.username}'s timer for {what}.")
+            else:
+                each = ', '.join(
+                    f"{char.username} ({self.duration(pen)} for {count})" for char, pen, count in entries
+                )
+                self.outbox.send(f"Penalties added for {summary}: {each}.")
+
     def penttl(self, level, ignore_level=False):
         """
         Calculate the magnitude of a penalty in ttl
@@ -1637,8 +1696,8 @@ class IdleRPG(discord.Client):
 my_intents = discord.Intents.all()
 devmsg('instantiating game')
 game = IdleRPG(intents=my_intents)
-
 loop = asyncio.get_event_loop()
+loop.add_signal_handler(signal.SIGINT, game.sigint)
 app = Quart(__name__)
 
 navigation = {
@@ -1709,7 +1768,7 @@ async def jon():
 
 @app.route("/db.html", methods=['GET'])
 async def db():
-    chars = game.characters.webchars()
+    chars = await game.characters.webchars(request.args.get('sort'))
     pagedict = {
         "request": request,
         "navigation": navigation,
@@ -1717,18 +1776,25 @@ async def db():
         "characters": chars,
         "rows": len(chars),
     }
-    return await render_template(template_name_or_list="db.html", context=pagedict)
+    async with game.characters.hydrated(chars.values()):
+        return await render_template(template_name_or_list="db.html", context=pagedict)
 
 
 @app.route("/playerview.html/<int:player_id>", methods=['GET'])
 async def playerview(player_id: int):
-    char = game.characters.find(player_id=player_id)
+    # Lent out for the page, not kept, so browsing offline players doesn't churn the resident set
+    chars = await game.characters.fetch([player_id])
+    if not chars:
+        abort(404)
+    char = chars[0]
     pagedict = {
         "navigation": navigation,
         "title": "Player Info: " + char.username,
         "character": char,
+        "rank": await game.characters.rank(char),
     }
-    return await render_template(template_name_or_list="playerview.html", context=pagedict)
+    async with game.characters.hydrated([char]):
+        return await render_template(template_name_or_list="playerview.html", context=pagedict)
 
 
 def main():
@@ -0,0 +1,56 @@
+"""
+This file contains a set that can also hand out a random member cheaply
+"""
+from random import choice
+
+
+class IndexedSet:
+    """
+    A set of hashable items kept in a list as well, so a random member can be picked in O(1).
+    Removal swaps the last item into the removed item's place.
+    """
+    def __init__(self):
+        self.items = []      # The members, in no particular order
+        self.positions = {}  # Dict of member to its index in items
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, item):
+        return item in self.positions
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def add(self, item) -> None:
+        """
+        Add an item, if it isn't already a member
+        :param item: hashable item
+        :return: None
+        """
+        if item in self.positions:
+            return
+        self.positions[item] = len(self.items)
+        self.items.append(item)
+
+    def discard(self, item) -> None:
+        """
+        Remove an item, if it is a member
+        :param item: hashable item
+        :return: None
+        """
+        index = self.positions.pop(item, None)
+        if index is None:
+            return
+        last = self.items.pop()
+        if index < len(self.items):
+            self.items[index] = last
+            self.positions[last] = index
+
+    def choice(self):
+        """
+        :return: a random member, or None if empty
+        """
+        if not self.items:
+            return None
+        return choice(self.items)
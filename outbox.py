@@ -0,0 +1,120 @@
+"""
+This file contains the queue that game announcements go through on their way to Discord
+"""
+import asyncio
+from collections import deque
+from devmsg import devmsg
+
+
+class Outbox:
+    """
+    Messages for one channel. The game queues them with send(), which never waits,
+    and run() posts them in order, packing as many as fit into each Discord message.
+    """
+    limit = 2000  # Discord's maximum message length
+
+    def __init__(self, maxlen: int = 1000, min_interval: float = 1.0):
+        """
+        :param maxlen: most messages to hold; the oldest are dropped past this
+        :param min_interval: least seconds between posts, to stay inside the channel's rate limit
+        """
+        self.channel = None  # Text channel to post to, set once we're connected
+        self.maxlen = maxlen
+        self.min_interval = min_interval
+        self.queue = deque()
+        self.wakeup = asyncio.Event()
+        self.idle = asyncio.Event()  # Set while nothing is queued or being posted
+        self.idle.set()
+        self.task = None     # The run() task, once started
+        self.sent = 0        # Messages posted
+        self.posts = 0       # Discord messages those were packed into
+        self.dropped = 0     # Messages dropped because the queue was full
+        self.failed = 0      # Discord messages that failed to post
+
+    def send(self, text: str) -> None:
+        """
+        Queue a message to be posted
+        :param text: message text
+        :return: None
+        """
+        if len(self.queue) >= self.maxlen:
+            self.queue.popleft()
+            self.dropped += 1
+        self.queue.append(text)
+        self.idle.clear()
+        self.wakeup.set()
+
+    def start(self, channel) -> None:
+        """
+        Start posting to a channel, if we aren't already
+        :param channel: discord text channel
+        :return: None
+        """
+        self.channel = channel
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def run(self) -> None:
+        """
+        Post queued messages forever
+        :return: None
+        """
+        while True:
+            if not self.queue:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+            text = self.pack()
+            try:
+                await self.channel.send(text)
+                self.posts += 1
+            except Exception as e:
+                devmsg(f"Exception: {e}")
+                self.failed += 1
+            if not self.queue:
+                self.idle.set()
+            await asyncio.sleep(self.min_interval)
+
+    def pack(self) -> str:
+        """
+        Take as many queued messages as fit into one Discord message
+        :return: text to post
+        """
+        parts = []
+        size = 0
+        while self.queue:
+            text = self.queue[0]
+            if len(text) > self.limit:
+                if parts:
+                    break
+                # Too long for Discord on its own, post it in pieces
+                self.queue[0] = text[self.limit:]
+                return text[:self.limit]
+            extra = len(text) + (1 if parts else 0)
+            if size + extra > self.limit:
+                break
+            parts.append(self.queue.popleft())
+            size += extra
+        self.sent += len(parts)
+        return '\n'.join(parts)
+
+    async def drain(self, timeout: float = 10) -> None:
+        """
+        Wait for the queue to empty and the last post to go out, or give up after a while
+        :param timeout: seconds to wait at most
+        :return: None
+        """
+        if self.task is None:
+            return
+        try:
+            await asyncio.wait_for(self.idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            devmsg(f"gave up waiting for the outbox: {self.stats()}")
+
+    def stats(self) -> str:
+        """
+        :return: one-line summary of the queue
+        """
+        return (
+            f"queued {len(self.queue)}, sent {self.sent} in {self.posts} posts, "
+            f"dropped {self.dropped}, failed {self.failed}"
+        )
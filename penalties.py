@@ -0,0 +1,93 @@
+"""
+This file contains the queue that message penalties build up in before they're applied
+"""
+import asyncio
+import traceback
+from devmsg import devmsg
+
+
+class PenaltyQueue:
+    """
+    Penalties for chatting, totalled per member and kind of penalty (a message, an edit...).
+    Each message's penalty is worked out when it's sent, so the totals are exactly what penalizing
+    them one at a time would give, but they're applied and announced together once every window
+    seconds instead of once per message.
+    """
+    def __init__(self, handler, window: float = 5.0):
+        """
+        :param handler: coroutine function taking a list of (member, kind, seconds, count of messages)
+        :param window: seconds to total penalties for before handing them over
+        """
+        self.handler = handler
+        self.window = window
+        self.pending = {}     # Dict of (member id, kind) to [member, kind, seconds, count of messages]
+        self.wakeup = asyncio.Event()
+        self.task = None      # The run() task, once started
+        self.messages = 0     # Messages penalized
+        self.batches = 0      # Batches handed over
+        self.failed = 0       # Batches whose handler raised an exception
+
+    def add(self, member, seconds: int, kind: str = 'message') -> None:
+        """
+        Penalize a member for one message
+        :param member: Member object of the author
+        :param seconds: penalty for the message
+        :param kind: what the penalty is for, totalled and announced separately
+        :return: None
+        """
+        self.messages += 1
+        key = (member.id, kind)
+        entry = self.pending.get(key)
+        if entry is None:
+            self.pending[key] = [member, kind, seconds, 1]
+            self.wakeup.set()
+        else:
+            entry[0] = member
+            entry[2] += seconds
+            entry[3] += 1
+
+    def start(self) -> None:
+        """
+        Start applying penalties, if we aren't already
+        :return: None
+        """
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def run(self) -> None:
+        """
+        Apply penalties every window seconds forever, while there are any
+        :return: None
+        """
+        while True:
+            if not self.pending:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+            await asyncio.sleep(self.window)
+            await self.flush()
+
+    async def flush(self) -> None:
+        """
+        Hand every penalty totalled so far to the handler now
+        :return: None
+        """
+        if not self.pending:
+            return
+        batch = list(self.pending.values())
+        self.pending = {}
+        try:
+            await self.handler(batch)
+        except Exception as e:
+            devmsg(f"Exception: {e}")
+            traceback.print_exc()
+            self.failed += 1
+        self.batches += 1
+
+    def stats(self) -> str:
+        """
+        :return: one-line summary of the queue
+        """
+        return (
+            f"{len(self.pending)} players waiting, {self.messages} messages "
+            f"in {self.batches} batches, {self.failed} failed"
+        )
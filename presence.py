@@ -0,0 +1,100 @@
+"""
+This file contains the queue that presence updates wait in to be handled in batches
+"""
+import asyncio
+import time
+import traceback
+from devmsg import devmsg
+
+
+class PresenceQueue:
+    """
+    Presence updates, coalesced per member. Only the member's state from before their first
+    update and after their latest one are kept, so a burst of updates (like everyone at once
+    after a Discord outage) costs one entry per member, however many events each one had.
+
+    run() waits window seconds after the first update of a batch, then hands every member's
+    (before, after) to the handler in one call.
+    """
+    def __init__(self, handler, window: float = 1.0):
+        """
+        :param handler: coroutine function taking a list of (before, after) member pairs
+        :param window: seconds to gather updates for before handling them
+        """
+        self.handler = handler
+        self.window = window
+        self.pending = {}     # Dict of member id to [before, after], in order of first update
+        self.wakeup = asyncio.Event()
+        self.task = None      # The run() task, once started
+        self.events = 0       # Presence updates received
+        self.merged = 0       # Updates folded into one already waiting
+        self.batches = 0      # Batches handled
+        self.handled = 0      # Members in those batches
+        self.failed = 0       # Batches whose handler raised an exception
+        self.last_duration = 0  # Seconds the last batch took
+
+    def put(self, before, after) -> None:
+        """
+        Queue a presence update
+        :param before: Member object before the update
+        :param after: Member object after the update
+        :return: None
+        """
+        self.events += 1
+        entry = self.pending.get(after.id)
+        if entry is None:
+            self.pending[after.id] = [before, after]
+            self.wakeup.set()
+        else:
+            entry[1] = after
+            self.merged += 1
+
+    def start(self) -> None:
+        """
+        Start handling updates, if we aren't already
+        :return: None
+        """
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def run(self) -> None:
+        """
+        Handle queued updates forever
+        :return: None
+        """
+        while True:
+            if not self.pending:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+            await asyncio.sleep(self.window)
+            await self.flush()
+
+    async def flush(self) -> None:
+        """
+        Hand every update queued so far to the handler now
+        :return: None
+        """
+        if not self.pending:
+            return
+        batch = list(self.pending.values())
+        self.pending = {}
+        start = time.monotonic()
+        try:
+            await self.handler(batch)
+        except Exception as e:
+            devmsg(f"Exception: {e}")
+            traceback.print_exc()
+            self.failed += 1
+        self.last_duration = time.monotonic() - start
+        self.batches += 1
+        self.handled += len(batch)
+
+    def stats(self) -> str:
+        """
+        :return: one-line summary of the queue
+        """
+        return (
+            f"queued {len(self.pending)}, {self.events} updates, {self.merged} merged, "
+            f"{self.handled} handled in {self.batches} batches (last {self.last_duration:.3f}s), "
+            f"{self.failed} failed"
+        )
@@ -0,0 +1,407 @@
+"""
+This file contains the sorted indexes used to rank characters for the top lists and web pages
+"""
+import asyncio
+import heapq
+import numpy as np
+from bisect import bisect_left, insort
+from itertools import islice
+from character import ITEMS
+from devmsg import devmsg
+
+PENALTIES = ('pen_msg', 'pen_nick', 'pen_part', 'pen_kick', 'pen_quit', 'pen_quest', 'pen_logout')
+
+# The sort orders as SQL, for sorting characters that aren't in memory.
+# CAST takes the leading digits, so stripping the prefix letter leaves an item's level.
+QUERY_ORDERS = {
+    'top':       [('level', True), ('next_ttl', False)],
+    'ttl':       [('next_ttl', False)],
+    'idled':     [('idled', False)],
+    'level':     [('level', False)],
+    'user':      [('lower(username)', False)],
+    'isadmin':   [('is_admin', False)],
+    'uhost':     [('userhost', False)],
+    'online':    [('online', False)],
+    'pen':       [(' + '.join(PENALTIES), False)],
+    'created':   [('cast(created as integer)', False)],
+    'lastlogin': [('cast(lastlogin as integer)', False)],
+    'sum':       [(' + '.join(f"cast(ltrim({item}, 'abcdefghijklmnopqrstuvwxyz') as integer)" for item in ITEMS), False)],
+    'alignment': [('alignment', False)],
+}
+
+
+class SortedIndex:
+    """
+    Character IDs kept sorted by a key, updated one character at a time as they change.
+    Built from scratch the first time it is queried.
+    """
+    def __init__(self, keyfunc):
+        """
+        :param keyfunc: callable taking a Character, returning its sort key
+        """
+        self.keyfunc = keyfunc
+        self.entries = None  # Sorted list of (key, id), None until built
+        self.keys = {}       # Dict of id to the key it is indexed under
+
+    def build(self, chars) -> None:
+        """
+        Sort every character
+        :param chars: dict of character ids to Character objects
+        :return: None
+        """
+        keyfunc = self.keyfunc
+        self.keys = {char_id: keyfunc(char) for char_id, char in chars.items()}
+        self.entries = sorted((key, char_id) for char_id, key in self.keys.items())
+
+    def update(self, char) -> None:
+        """
+        Move a character to where its current key belongs
+        :param char: Character object
+        :return: None
+        """
+        if self.entries is None:
+            return
+        key = self.keyfunc(char)
+        old = self.keys.get(char.id)
+        if old == key:
+            return
+        if old is not None:
+            del self.entries[bisect_left(self.entries, (old, char.id))]
+        self.keys[char.id] = key
+        insort(self.entries, (key, char.id))
+
+    def remove(self, char_id) -> None:
+        """
+        Drop a character from the index
+        :param char_id: character's id
+        :return: None
+        """
+        if self.entries is None:
+            return
+        old = self.keys.pop(char_id, None)
+        if old is not None:
+            del self.entries[bisect_left(self.entries, (old, char_id))]
+
+    def ids(self, chars, start: int, stop: int, reverse: bool) -> list:
+        """
+        :param chars: dict of character ids to Character objects, used to build if needed
+        :param start: first position wanted
+        :param stop: position after the last one wanted, None for all the rest
+        :param reverse: count positions from the highest key instead of the lowest
+        :return: list of character ids
+        """
+        if self.entries is None:
+            self.build(chars)
+        entries = self.entries
+        if reverse:
+            size = len(entries)
+            if stop is None:
+                stop = size
+            start, stop = max(size - stop, 0), max(size - start, 0)
+            return [char_id for key, char_id in reversed(entries[start:stop])]
+        return [char_id for key, char_id in entries[start:stop]]
+
+    def rank(self, chars, char) -> int:
+        """
+        :param chars: dict of character ids to Character objects, used to build if needed
+        :param char: Character object
+        :return: 0-based position of the character
+        """
+        if self.entries is None:
+            self.build(chars)
+        return bisect_left(self.entries, (self.keys[char.id], char.id))
+
+
+class ArrayIndex:
+    """
+    Character IDs sorted by CharStore columns, including next_ttl and idled, which change every tick.
+    The clock moves every online character's next_ttl and idled alike, so online characters are kept
+    sorted by their deadline and when they started idling, which it doesn't touch, and offline ones by
+    their frozen values. Both are updated one character at a time like SortedIndex, and merged at the
+    current clock when read.
+    """
+    SHIFTS = {'next_ttl': -1, 'idled': 1}  # How far an online character's value moves per second of clock
+
+    def __init__(self, store, columns):
+        """
+        :param store: CharStore
+        :param columns: list of (array name, descending) pairs, most significant first
+        """
+        self.store = store
+        self.columns = columns
+        self.online = None   # Sorted list of (key as of clock 0, id) of online characters, None until built
+        self.offline = None  # Sorted list of (key, id) of offline characters
+        self.keys = {}       # Dict of id to the (online, key) it is indexed under
+
+    def row_keys(self, rows) -> list:
+        """
+        :param rows: list of store rows
+        :return: list of (online, key) for each row, online keys as of clock 0
+        """
+        store = self.store
+        rows = np.asarray(rows, dtype=np.int64)
+        online = store.online[rows] == 1
+        parts = []
+        for name, descending in self.columns:
+            values = getattr(store, name)[rows].astype(np.int64)
+            if name == 'next_ttl':
+                values = np.where(online, store.deadline[rows], values)
+            elif name == 'idled':
+                values = np.where(online, -store.idle_origin[rows], values)
+            parts.append((-values if descending else values).tolist())
+        return list(zip(online.tolist(), zip(*parts)))
+
+    def shift(self) -> tuple:
+        """
+        :return: what to add to an online key to get its key at the current clock
+        """
+        clock = self.store.clock
+        return tuple(
+            self.SHIFTS.get(name, 0) * (-clock if descending else clock) for name, descending in self.columns
+        )
+
+    def build(self, chars) -> None:
+        """
+        Sort every character
+        :param chars: dict of character ids to Character objects
+        :return: None
+        """
+        self.keys = dict(zip(chars, self.row_keys([char._row for char in chars.values()])))
+        self.online = sorted((key, char_id) for char_id, (online, key) in self.keys.items() if online)
+        self.offline = sorted((key, char_id) for char_id, (online, key) in self.keys.items() if not online)
+
+    def update(self, char) -> None:
+        """
+        Move a character to where its current key belongs
+        :param char: Character object
+        :return: None
+        """
+        if self.online is None:
+            return
+        new = self.row_keys([char._row])[0]
+        if self.keys.get(char.id) == new:
+            return
+        self.remove(char.id)
+        self.keys[char.id] = new
+        insort(self.online if new[0] else self.offline, (new[1], char.id))
+
+    def remove(self, char_id) -> None:
+        """
+        Drop a character from the index
+        :param char_id: character's id
+        :return: None
+        """
+        if self.online is None:
+            return
+        old = self.keys.pop(char_id, None)
+        if old is not None:
+            entries = self.online if old[0] else self.offline
+            del entries[bisect_left(entries, (old[1], char_id))]
+
+    def ids(self, chars, start: int, stop: int, reverse: bool) -> list:
+        """
+        :param chars: dict of character ids to Character objects, used to build if needed
+        :param start: first position wanted
+        :param stop: position after the last one wanted, None for all the rest
+        :param reverse: count positions from the end instead of the beginning
+        :return: list of character ids
+        """
+        if self.online is None:
+            self.build(chars)
+        shift = self.shift()
+        online = reversed(self.online) if reverse else self.online
+        offline = reversed(self.offline) if reverse else self.offline
+        now = ((tuple(k + s for k, s in zip(key, shift)), char_id) for key, char_id in online)
+        return [char_id for key, char_id in islice(heapq.merge(now, offline, reverse=reverse), start, stop)]
+
+    def rank(self, chars, char) -> int:
+        """
+        :param chars: dict of character ids to Character objects, used to build if needed
+        :param char: Character object
+        :return: 0-based position of the character
+        """
+        if self.online is None:
+            self.build(chars)
+        online, key = self.keys[char.id]
+        shift = self.shift()
+        if online:
+            now = tuple(k + s for k, s in zip(key, shift))
+            return bisect_left(self.online, (key, char.id)) + bisect_left(self.offline, (now, char.id))
+        then = tuple(k - s for k, s in zip(key, shift))
+        return bisect_left(self.offline, (key, char.id)) + bisect_left(self.online, (then, char.id))
+
+
+class QueryIndex:
+    """
+    Character IDs sorted by the database, for columns or characters that aren't kept in memory.
+    Changes only show up once they've been written. Queries wait behind queued writes,
+    so ids() and rank() are coroutines here.
+    """
+    def __init__(self, db, order):
+        """
+        :param db: database.Database
+        :param order: list of (SQL expression on the characters table, descending) pairs, most significant first
+        """
+        self.db = db
+        self.order = order
+
+    def update(self, char) -> None:
+        """
+        Nothing to do, the database keeps its own order
+        :param char: Character object
+        :return: None
+        """
+        return
+
+    def remove(self, char_id) -> None:
+        """
+        Nothing to do, the database keeps its own order
+        :param char_id: character's id
+        :return: None
+        """
+        return
+
+    async def ids(self, chars, start: int, stop: int, reverse: bool) -> list:
+        """
+        :param chars: unused, here to match SortedIndex
+        :param start: first position wanted
+        :param stop: position after the last one wanted, None for all the rest
+        :param reverse: count positions from the highest key instead of the lowest
+        :return: list of character ids
+        """
+        terms = [
+            f"{expr} {'asc' if descending == reverse else 'desc'}"
+            for expr, descending in self.order + [('id', False)]
+        ]
+        cols, rows = await self.db.read(
+            f"select id from characters order by {', '.join(terms)} limit ? offset ?",
+            (-1 if stop is None else stop - start, start)
+        )
+        return [row[0] for row in rows]
+
+    async def rank(self, chars, char) -> int:
+        """
+        :param chars: unused, here to match SortedIndex
+        :param char: Character object
+        :return: 0-based position of the character
+        """
+        # Count the rows that sort before the character's row: better on the first key,
+        # or level on it and better on the next, and so on down to the id
+        keys = self.order + [('id', False)]
+        condition = ''
+        for n, (expr, descending) in reversed(list(enumerate(keys))):
+            before = f"{expr} {'>' if descending else '<'} me.k{n}"
+            condition = before if not condition else f"{before} or ({expr} = me.k{n} and ({condition}))"
+        picks = ', '.join(f"{expr} as k{n}" for n, (expr, descending) in enumerate(keys))
+        cols, rows = await self.db.read(
+            f"select count(*) from characters, (select {picks} from characters where id = ?) as me "
+            f"where {condition}",
+            (char.id,)
+        )
+        return rows[0][0]
+
+
+class Ranking:
+    """
+    All the ways characters can be sorted, kept ready so pages don't re-sort everyone on every hit.
+    When only some characters are in memory, the database does all the sorting instead.
+    """
+    def __init__(self, chars, store, db, resident: bool = False):
+        """
+        :param chars: dict of character ids to Character objects
+        :param store: CharStore holding the per-tick columns
+        :param db: database.Database, for sorting by the cold columns
+        :param resident: True if chars only holds some of the characters
+        """
+        self.chars = chars
+        if resident:
+            self.indexes = {name: QueryIndex(db, order) for name, order in QUERY_ORDERS.items()}
+            self.depends = {}
+            return
+        self.indexes = {
+            'top':       ArrayIndex(store, [('level', True), ('next_ttl', False)]),
+            'ttl':       ArrayIndex(store, [('next_ttl', False)]),
+            'idled':     ArrayIndex(store, [('idled', False)]),
+            'level':     SortedIndex(lambda c: c.level),
+            'user':      SortedIndex(lambda c: c.username.lower()),
+            'isadmin':   SortedIndex(lambda c: c.is_admin),
+            'uhost':     QueryIndex(db, QUERY_ORDERS['uhost']),
+            'online':    SortedIndex(lambda c: c.online),
+            'pen':       SortedIndex(lambda c: sum(getattr(c, pen) for pen in PENALTIES)),
+            'created':   QueryIndex(db, QUERY_ORDERS['created']),
+            'lastlogin': SortedIndex(lambda c: int(c.lastlogin)),
+            'sum':       SortedIndex(lambda c: c.itemsum()),
+            'alignment': SortedIndex(lambda c: c.alignment),
+        }
+        # Dict of column name to the indexes sorted by it. The database keeps uhost and created in order.
+        self.depends = {
+            'level':     ('top', 'level'),
+            'next_ttl':  ('top', 'ttl'),
+            'idled':     ('idled',),
+            'username':  ('user',),
+            'is_admin':  ('isadmin',),
+            'online':    ('online', 'top', 'ttl', 'idled'),  # Online next_ttl and idled follow the clock
+            'lastlogin': ('lastlogin',),
+            'alignment': ('alignment',),
+        }
+        for pen in PENALTIES:
+            self.depends[pen] = ('pen',)
+        for item in ITEMS:
+            self.depends[item] = ('sum',)
+
+    def add(self, char) -> None:
+        """
+        Start ranking a new character
+        :param char: Character object
+        :return: None
+        """
+        for index in self.indexes.values():
+            index.update(char)
+
+    def changed(self, char, column: str) -> None:
+        """
+        Re-rank a character after one of its columns changed
+        :param char: Character object
+        :param column: column name
+        :return: None
+        """
+        for name in self.depends.get(column, ()):
+            self.indexes[name].update(char)
+
+    def remove(self, char) -> None:
+        """
+        Stop ranking a character
+        :param char: Character object
+        :return: None
+        """
+        for index in self.indexes.values():
+            index.remove(char.id)
+
+    async def ordered(self, sort: str = 'top', reverse: bool = False, start: int = 0, count: int = None) -> list:
+        """
+        Get a page of character ids in sorted order
+        :param sort: name of the sort order, one of self.indexes
+        :param reverse: give the order backwards
+        :param start: position to start from
+        :param count: how many characters to return, None for all of them
+        :return: list of character ids
+        """
+        index = self.indexes.get(sort)
+        if index is None:
+            devmsg(f"unknown sort '{sort}', using top")
+            index = self.indexes['top']
+        stop = None if count is None else start + count
+        if isinstance(index, QueryIndex):
+            return await index.ids(self.chars, start, stop, reverse)
+        return index.ids(self.chars, start, stop, reverse)
+
+    async def rank(self, char, sort: str = 'top') -> int:
+        """
+        :param char: Character object
+        :param sort: name of the sort order, one of self.indexes
+        :return: 1-based rank of the character
+        """
+        index = self.indexes[sort]
+        if isinstance(index, QueryIndex):
+            return await index.rank(self.chars, char) + 1
+        return index.rank(self.chars, char) + 1
@@ -0,0 +1,162 @@
+"""
+This file contains the game's flavor content: monsters, events and celebrities
+"""
+import os
+from bisect import bisect_left
+from devmsg import devmsg
+from random import choice
+
+# Fantasy celebrities to fight, as (name, level)
+CELEBRITIES = (
+    ('Humpty Dumpty',           0),
+    ('Tweedledee',              0),
+    ('Tweedledum',              0),
+    ('Cheshire Cat',            1),
+    ('Oompa Loompa',            1),
+    ('Bilbo Baggins',           2),
+    ('Hermione Granger',        2),
+    ('Princess Buttercup',      2),
+    ('Frodo Baggins',           3),
+    ('Samwise Gamgee',          3),
+    ('Gollum',                  4),
+    ('Circe',                   4),
+    ('Robin Hood',              5),
+    ('Harry Potter',            5),
+    ('Shrek',                   6),
+    ('Princess Fiona',          6),
+    ('Conan',                   7),
+    ('Harry Dresden',           7),
+    ('Captain Jack Sparrow',    7),
+    ('Medusa',                  8),
+    ('King Arthur',             8),
+    ('Joan of Arc',             8),
+    ('Merlin',                  9),
+    ('Richard Rahl',            9),
+    ('Van Helsing',             9),
+    ('Saruman',                10),
+    ('Belgarath',              10),
+    ('Dread Pirate Roberts',   10),
+    ('Severus Snape',          11),
+    ("Zeddicus Zu'l Zorander", 11),
+    ('Albus Dumbledore',       12),
+    ('Lord Voldemort',         13),
+    ('Gandalf the Grey',       15),
+    ('Elminster',              15),
+)
+
+
+class ContentRegistry:
+    """
+    Monsters and events, read once and kept in memory.
+    Files are read again whenever refresh() sees their modification time change.
+    """
+    def __init__(self, monsters_file: str = 'monsters.txt', events_file: str = 'events.txt'):
+        """
+        :param monsters_file: path of the file of '<sum> <name>' lines, sorted by sum
+        :param events_file: path of the file of '<type> <flavor>' lines
+        """
+        self.monsters_file = monsters_file
+        self.events_file = events_file
+        self.monster_sums = []   # Sorted list of monster sums
+        self.monster_names = []  # Monster names, same order as monster_sums
+        self.events = {}         # Dict of event type ('G', 'C', 'Q1'...) to list of flavor texts
+        self.mtimes = {}         # Dict of file path to its modification time when last loaded
+        self.refresh()
+
+    def refresh(self) -> None:
+        """
+        Load any content file that changed since it was last loaded. A file that can't be read or
+        parsed, like one that's half saved, leaves what we had in place and is tried again next time.
+        :return: None
+        """
+        for path, load in ((self.monsters_file, self.load_monsters), (self.events_file, self.load_events)):
+            mtime = self.mtime(path)
+            if mtime is None or self.mtimes.get(path) == mtime:
+                continue
+            try:
+                load()
+            except (OSError, ValueError) as e:
+                devmsg(f"can't load {path}, keeping what we had: {e}")
+                continue
+            # If it changed while we read it, read it again next time
+            if self.mtime(path) == mtime:
+                self.mtimes[path] = mtime
+
+    @staticmethod
+    def mtime(path: str):
+        """
+        :param path: file path
+        :return: the file's modification time, or None if it can't be had
+        """
+        try:
+            return os.stat(path).st_mtime
+        except OSError as e:
+            devmsg(f"can't stat {path}: {e}")
+            return None
+
+    def load_monsters(self) -> None:
+        """
+        Read the monsters file, only replacing the monsters we have if all of it parses
+        :return: None
+        """
+        monsters = []
+        with open(self.monsters_file, 'r') as mfile:
+            for mline in mfile:
+                mline = mline.rstrip()
+                if mline == "":
+                    continue
+                monster_sum, monster_name = mline.split(None, 1)
+                monsters.append((int(monster_sum), monster_name))
+        monsters.sort(key=lambda monster: monster[0])
+        self.monster_sums = [monster_sum for monster_sum, monster_name in monsters]
+        self.monster_names = [monster_name for monster_sum, monster_name in monsters]
+        devmsg(f"loaded {len(monsters)} monsters")
+
+    def load_events(self) -> None:
+        """
+        Read the events file, only replacing the events we have if all of it parses
+        :return: None
+        """
+        events = {}
+        with open(self.events_file, 'r') as efile:
+            for eline in efile:
+                eline = eline.rstrip()
+                if eline == "":
+                    continue
+                e_type, flavor = eline.split(None, 1)
+                events.setdefault(e_type, []).append(flavor)
+        self.events = events
+        devmsg(f"loaded {sum(len(flavors) for flavors in events.values())} events")
+
+    def monster_name(self, target_monster_sum: int) -> str:
+        """
+        Get an appropriate monster name for the sum provided
+        :param target_monster_sum: monster sum
+        :return: name of the weakest monster at least that strong, or the strongest there is
+        """
+        if not self.monster_names:
+            return "Monster"
+        index = bisect_left(self.monster_sums, target_monster_sum)
+        if index == len(self.monster_names):
+            index -= 1
+        return self.monster_names[index]
+
+    def event(self, e_type: str, default: str) -> str:
+        """
+        Pick a random flavor text of an event type
+        :param e_type: event type, like 'G' for godsend or 'C' for calamity
+        :param default: text to use if there are none of that type
+        :return: flavor text
+        """
+        flavors = self.events.get(e_type)
+        if not flavors:
+            return default
+        return choice(flavors)
+
+    @staticmethod
+    def celebrity():
+        """
+        Pick a random celebrity
+        :return: (name, level)
+        """
+        return choice(CELEBRITIES)
@@ -0,0 +1,130 @@
+"""
+This file contains the service that keeps members' status roles in line with their Discord status
+"""
+import asyncio
+from devmsg import devmsg
+
+
+class RoleSync:
+    """
+    Gives members the Online, Idle or DND role matching their status, and takes the others away.
+    Requests are queued and worked by a few tasks, so role calls never hold up the game,
+    and only the calls that would actually change something are made.
+
+    A request can wait out a settle window first. Asking again for the same member during
+    the window only swaps in the newer member object, so a status flapping back and forth
+    costs one sync, and none at all if it ends up where it started. A member being synced
+    isn't queued again until their calls are done, so no two workers sync the same member.
+    """
+    reason = "IdleRPG Role Status Adjustment"
+
+    def __init__(self, workers: int = 4):
+        """
+        :param workers: most role calls to have going at once
+        """
+        self.roles = {}       # Dict of raw_status to the role members with that status should have
+        self.workers = workers
+        self.queue = asyncio.Queue()  # IDs of members to sync
+        self.pending = {}     # Dict of member id to the latest member object asked for
+        self.active = set()   # IDs of members whose role calls are in flight
+        self.tasks = []
+        self.calls = 0        # Role calls made
+        self.skipped = 0      # Syncs that needed no calls
+        self.failed = 0       # Role calls that failed
+        self.merged = 0       # Requests folded into one already waiting
+
+    def set_roles(self, online, idle, dnd) -> None:
+        """
+        :param online: role for members who are online
+        :param idle: role for members who are idle
+        :param dnd: role for members who are on do not disturb
+        :return: None
+        """
+        self.roles = {'online': online, 'idle': idle, 'dnd': dnd}
+
+    def start(self) -> None:
+        """
+        Start the worker tasks, if they aren't running already
+        :return: None
+        """
+        if self.tasks:
+            return
+        loop = asyncio.get_running_loop()
+        self.tasks = [loop.create_task(self.run()) for _ in range(self.workers)]
+
+    def request(self, member, settle: float = 0) -> None:
+        """
+        Queue a member to have their roles synced. Asking again before it's done just updates the request.
+        :param member: Member object
+        :param settle: seconds to wait for the member's status to settle before queueing
+        :return: None
+        """
+        if member.id in self.pending:
+            self.merged += 1
+        elif member.id in self.active:
+            pass  # Queued again by run() once the calls in flight are done
+        elif settle > 0:
+            asyncio.get_running_loop().call_later(settle, self.queue.put_nowait, member.id)
+        else:
+            self.queue.put_nowait(member.id)
+        self.pending[member.id] = member
+
+    def changes(self, member) -> tuple:
+        """
+        Work out which roles need to change for a member's current status
+        :param member: Member object
+        :return: (role to add or None, list of roles to remove)
+        """
+        target = self.roles.get(member.raw_status)  # Nobody gets a role while offline
+        have = member.roles
+        add = target if target is not None and target not in have else None
+        remove = [role for role in self.roles.values() if role is not None and role != target and role in have]
+        return add, remove
+
+    async def run(self) -> None:
+        """
+        Sync queued members forever
+        :return: None
+        """
+        while True:
+            member_id = await self.queue.get()
+            member = self.pending.pop(member_id, None)
+            if member is None:
+                continue
+            self.active.add(member_id)
+            try:
+                await self.apply(member)
+            finally:
+                self.active.discard(member_id)
+                if member_id in self.pending:
+                    self.queue.put_nowait(member_id)
+
+    async def apply(self, member) -> None:
+        """
+        Make only the role calls a member needs
+        :param member: Member object
+        :return: None
+        """
+        add, remove = self.changes(member)
+        if add is None and not remove:
+            self.skipped += 1
+            return
+        try:
+            if remove:
+                self.calls += 1
+                await member.remove_roles(*remove, reason=self.reason)
+            if add is not None:
+                self.calls += 1
+                await member.add_roles(add, reason=self.reason)
+        except Exception as e:
+            devmsg(f"Exception: {e}")
+            self.failed += 1
+
+    def stats(self) -> str:
+        """
+        :return: one-line summary of role syncing
+        """
+        return (
+            f"queued {len(self.pending)}, {self.calls} calls, {self.skipped} skipped, "
+            f"{self.merged} merged, {self.failed} failed"
+        )
@@ -0,0 +1,233 @@
+"""
+This file contains the schedulers that decide when things happen in the game
+"""
+import asyncio
+import heapq
+import time
+import traceback
+from devmsg import devmsg
+from random import expovariate
+
+
+async def cooperative(items, chunk: int = 100, budget: float = 0.01):
+    """
+    Iterate over items, letting the event loop run other tasks every chunk items or every
+    budget seconds, whichever comes first, so long loops don't hold up Discord or the web server
+    :param items: iterable
+    :param chunk: most items to hand out between yields
+    :param budget: most seconds to run between yields
+    :return: async generator of the items
+    """
+    count = 0
+    start = time.monotonic()
+    for item in items:
+        yield item
+        count += 1
+        if count >= chunk or time.monotonic() - start >= budget:
+            await asyncio.sleep(0)
+            count = 0
+            start = time.monotonic()
+
+
+class EventScheduler:
+    """
+    Random game events. Each fires after an exponentially distributed wait whose rate is
+    its population (online players, good players...) divided by its average period per player,
+    so events happen as often as they should however late or often the game loop runs.
+    """
+    def __init__(self):
+        self.events = {}  # Dict of event name to (population name, period in seconds, action)
+        self.rates = {}   # Dict of event name to its current rate per second
+        self.due = {}     # Dict of event name to when it fires next, None if it can't fire
+        self.heap = []    # Min-heap of (when, event name). Entries that don't match self.due are skipped.
+
+    def add(self, name: str, population: str, period: float, action) -> None:
+        """
+        Add an event type
+        :param name: unique event name
+        :param population: name of the count the rate scales with, as given to update()
+        :param period: average seconds between firings per member of the population
+        :param action: what to hand back from pop_due() when it fires
+        :return: None
+        """
+        self.events[name] = (population, period, action)
+        self.rates[name] = 0
+        self.due[name] = None
+
+    def update(self, populations: dict, now: float) -> None:
+        """
+        Resample the next firing of every event whose population changed.
+        Waits are memoryless, so throwing the old sample away keeps frequencies right.
+        :param populations: dict of population name to current count
+        :param now: current time
+        :return: None
+        """
+        for name, (population, period, action) in self.events.items():
+            rate = populations.get(population, 0) / period
+            if rate == self.rates[name]:
+                continue
+            self.rates[name] = rate
+            self.schedule(name, now)
+
+    def schedule(self, name: str, start: float) -> None:
+        """
+        Pick when an event fires next
+        :param name: event name
+        :param start: time to count the wait from
+        :return: None
+        """
+        rate = self.rates[name]
+        if rate <= 0:
+            self.due[name] = None
+            return
+        when = start + expovariate(rate)
+        self.due[name] = when
+        heapq.heappush(self.heap, (when, name))
+
+    def pop_due(self, now: float) -> list:
+        """
+        Get every event due by now, in the order they were due, and schedule their next firing
+        :param now: current time
+        :return: list of event actions
+        """
+        heap = self.heap
+        fired = set()
+        actions = []
+        while heap and heap[0][0] <= now:
+            when, name = heapq.heappop(heap)
+            if self.due[name] != when or name in fired:
+                continue
+            fired.add(name)
+            actions.append(self.events[name][2])
+            self.schedule(name, when)
+        # Anything due again before now fires next tick, rather than in a burst
+        for name in fired:
+            due = self.due[name]
+            if due is not None and due <= now:
+                heapq.heappush(heap, (due, name))
+        return actions
+
+
+class TickScheduler:
+    """
+    Runs the game tick at a fixed rate, aiming at absolute deadlines so the period doesn't drift
+    by however long each tick takes. When it falls a whole period or more behind, the missed
+    ticks are skipped and their time is left for the next tick to catch up on.
+
+    In adaptive mode the period stretches, up to max_period, while ticks take more than budget
+    of it, and shrinks back towards min_period while they take much less.
+    """
+    def __init__(self, period: float, tick, adaptive: bool = False, max_period: float = None,
+                 budget: float = 0.5, shed_load: float = 0.8):
+        """
+        :param period: seconds between ticks, and the shortest period in adaptive mode
+        :param tick: coroutine function to run each tick
+        :param adaptive: change the period to suit the load
+        :param max_period: longest period in adaptive mode, defaults to 5 times period
+        :param budget: fraction of the period a tick should take at most
+        :param shed_load: smoothed fraction of the period ticks take, past which overloaded() is True
+        """
+        self.period = period
+        self.min_period = period
+        self.max_period = max_period if max_period is not None else period * 5
+        self.adaptive = adaptive
+        self.budget = budget
+        self.shed_load = shed_load
+        self.tick = tick
+        self.running = False
+        self.wakeup = None       # Event that cuts the wait for the next tick short, set by stop()
+        self.load = 0            # Smoothed fraction of the period that ticks take
+        self.shed = 0            # Pieces of work skipped because we were overloaded
+        self.ticks = 0           # Ticks run
+        self.skipped = 0         # Ticks skipped because we were too far behind
+        self.overruns = 0        # Ticks that took longer than the period
+        self.errors = 0          # Ticks that raised an exception
+        self.last_duration = 0   # Seconds the last tick took
+        self.max_duration = 0    # Most seconds any tick took
+        self.total_duration = 0  # Seconds spent in all ticks
+        self.last_lag = 0        # Seconds the last tick started after its deadline
+        self.max_lag = 0         # Most seconds any tick started after its deadline
+
+    async def run(self) -> None:
+        """
+        Tick until stop() is called
+        :return: None
+        """
+        self.running = True
+        self.wakeup = asyncio.Event()
+        deadline = time.monotonic()
+        while self.running:
+            start = time.monotonic()
+            lag = start - deadline
+            try:
+                await self.tick()
+            except Exception as e:
+                self.errors += 1
+                devmsg(f"Exception: {e}")
+                traceback.print_exc()
+            duration = time.monotonic() - start
+            self.ticks += 1
+            self.last_duration = duration
+            self.max_duration = max(self.max_duration, duration)
+            self.total_duration += duration
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+            if duration > self.period:
+                self.overruns += 1
+            self.load = 0.8 * self.load + 0.2 * duration / self.period
+            if self.adaptive:
+                self.adapt(duration)
+
+            deadline += self.period
+            behind = time.monotonic() - deadline
+            if behind >= self.period:
+                missed = int(behind // self.period)
+                self.skipped += missed
+                deadline += missed * self.period
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), max(0.0, deadline - time.monotonic()))
+            except asyncio.TimeoutError:
+                pass
+
+    def adapt(self, duration: float) -> None:
+        """
+        Stretch the period if the last tick went over budget, shrink it if the tick was quick
+        :param duration: seconds the last tick took
+        :return: None
+        """
+        if duration > self.budget * self.period:
+            period = min(self.max_period, self.period * 1.5)
+        elif duration < self.budget * self.period / 4:
+            period = max(self.min_period, self.period * 0.9)
+        else:
+            return
+        if period != self.period:
+            devmsg(f"tick period {self.period:.2f}s -> {period:.2f}s")
+            self.period = period
+
+    def overloaded(self) -> bool:
+        """
+        :return: True if ticks have been taking too much of their period, so optional work should be skipped
+        """
+        return self.load > self.shed_load
+
+    def stop(self) -> None:
+        """
+        Stop ticking once the current tick is done
+        :return: None
+        """
+        self.running = False
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    def stats(self) -> str:
+        """
+        :return: one-line summary of tick timing
+        """
+        average = self.total_duration / self.ticks if self.ticks else 0
+        return (
+            f"{self.ticks} ticks every {self.period:.2f}s, load {self.load:.2f}, "
+            f"last {self.last_duration:.3f}s, avg {average:.3f}s, "
+            f"max {self.max_duration:.3f}s, lag {self.last_lag:.3f}s (max {self.max_lag:.3f}s), "
+            f"{self.overruns} overruns, {self.skipped} skipped, {self.errors} errors, {self.shed} shed"
+        )
@@ -0,0 +1,78 @@
+"""
+This file contains the per-shard share of the bot's event handling
+"""
+import presence
+import penalties
+import rolesync
+import time
+
+
+class Shard:
+    """
+    One gateway connection's own presence, message penalty and role queues, so a shard that's
+    busy or reconnecting only holds up its own guilds, plus counters for how it's doing.
+    The game tick doesn't wait on any of them.
+    """
+    def __init__(self, shard_id: int, presence_handler, penalty_handler,
+                 presence_window: float = 1.0, penalty_window: float = 5.0, role_workers: int = 4):
+        """
+        :param shard_id: Discord shard id
+        :param presence_handler: coroutine function for batches of presence updates
+        :param penalty_handler: coroutine function for batches of message penalties
+        :param presence_window: seconds to gather presence updates for
+        :param penalty_window: seconds to total up message penalties for
+        :param role_workers: most role changes to have in flight at once on this shard
+        """
+        self.id = shard_id
+        self.presence = presence.PresenceQueue(presence_handler, window=presence_window)
+        self.penalties = penalties.PenaltyQueue(penalty_handler, window=penalty_window)
+        self.rolesync = rolesync.RoleSync(workers=role_workers)
+        self.connected = False
+        self.since = time.time()  # When connected last changed
+        self.connects = 0
+        self.disconnects = 0
+        self.resumes = 0
+        self.readies = 0
+
+    def start(self) -> None:
+        """
+        Start working the queues, if we aren't already
+        :return: None
+        """
+        self.rolesync.start()
+        self.presence.start()
+        self.penalties.start()
+
+    def connect(self) -> None:
+        """
+        Note the shard (re)connected
+        :return: None
+        """
+        self.connected = True
+        self.since = time.time()
+        self.connects += 1
+
+    def disconnect(self) -> None:
+        """
+        Note the shard lost its connection
+        :return: None
+        """
+        self.connected = False
+        self.since = time.time()
+        self.disconnects += 1
+
+    def stats(self, latency: float = None) -> str:
+        """
+        :param latency: the shard's heartbeat latency in seconds, if known
+        :return: one-line summary of the shard
+        """
+        state = 'up' if self.connected else 'down'
+        ping = f", latency {latency * 1000:.0f}ms" if latency is not None and latency == latency else ''
+        return (
+            f"shard {self.id}: {state} for {int(time.time() - self.since)}s{ping}, "
+            f"{self.connects} connects, {self.disconnects} disconnects, {self.resumes} resumes, "
+            f"{self.readies} readies\n"
+            f"  presence: {self.presence.stats()}\n"
+            f"  penalties: {self.penalties.stats()}\n"
+            f"  roles: {self.rolesync.stats()}"
+        )
@@ -0,0 +1,103 @@
+"""
+This file contains the character snapshot, a binary copy of the characters table for fast restarts
+"""
+import numpy as np
+import os
+import zipfile
+from devmsg import devmsg
+
+
+class Snapshot:
+    """
+    Every character column saved as a NumPy array, all in one uncompressed .npz file.
+
+    Each snapshot carries a generation number. The database keeps the generation of its last
+    write in its user_version, so a snapshot whose generation doesn't match was taken before
+    some later write and is ignored. Edit the database by hand? Delete the snapshot.
+    """
+    version = 2  # Bump when the file layout changes
+
+    def __init__(self, filename: str = 'irpg.snapshot'):
+        """
+        :param filename: snapshot file
+        """
+        self.filename = filename
+
+    @staticmethod
+    def columns(chars, schema: dict) -> dict:
+        """
+        Take the current values of every character's columns, as the database would give them back.
+        Like SQLite, numbers in TEXT columns become text and numeric text in INTEGER columns becomes numbers.
+        :param chars: list of Character objects
+        :param schema: dict of column name to declared type
+        :return: dict of column name to list of values
+        """
+        columns = {}
+        for name, kind in schema.items():
+            values = [getattr(c, name) for c in chars]
+            if kind == 'TEXT':
+                values = [str(val) if isinstance(val, int) else val for val in values]
+            elif kind == 'INTEGER':
+                values = [int(val) if isinstance(val, str) and val.lstrip('-').isdigit() else val for val in values]
+            columns[name] = values
+        return columns
+
+    def save(self, columns: dict, generation: int) -> None:
+        """
+        Write the snapshot, replacing the old one only once the new one is complete
+        :param columns: dict of column name to list of values, as from columns(), or to an array of ints or text
+        :param generation: database generation the values match
+        :return: None
+        """
+        arrays = {'_meta': np.array([self.version, generation], dtype=np.int64)}
+        for name, values in columns.items():
+            if isinstance(values, np.ndarray):
+                arrays[name] = values if values.dtype.kind == 'U' else values.astype(np.int64)
+                continue
+            nulls = np.array([val is None for val in values], dtype=bool)
+            if all(isinstance(val, int) or val is None for val in values):
+                arrays[name] = np.array([0 if val is None else val for val in values], dtype=np.int64)
+            else:
+                # Text, or a mix of text and numbers; remember which were numbers
+                arrays[name] = np.array(['' if val is None else str(val) for val in values], dtype=np.str_)
+                arrays[f"{name}.int"] = np.array([isinstance(val, int) for val in values], dtype=bool)
+            if nulls.any():
+                arrays[f"{name}.null"] = nulls
+        temp = f"{self.filename}.tmp"
+        with open(temp, 'wb') as f:
+            np.savez(f, **arrays)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp, self.filename)
+
+    def load(self, generation: int):
+        """
+        Read the snapshot, if there is one and it matches the database
+        :param generation: the database's current generation
+        :return: dict of column name to list of values, or None if the snapshot can't be used
+        """
+        try:
+            with np.load(self.filename) as npz:
+                arrays = {name: npz[name] for name in npz.files}
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, zipfile.BadZipFile) as e:
+            devmsg(f"unreadable snapshot: {e}")
+            return None
+        version, saved = arrays.pop('_meta').tolist()
+        if version != self.version or saved != generation or generation == 0:
+            devmsg(f"stale snapshot: generation {saved}, database at {generation}")
+            return None
+        columns = {}
+        for name, array in arrays.items():
+            if '.' in name:
+                continue
+            values = array.tolist()
+            ints = arrays.get(f"{name}.int")
+            if ints is not None:
+                values = [int(val) if is_int else val for val, is_int in zip(values, ints.tolist())]
+            nulls = arrays.get(f"{name}.null")
+            if nulls is not None:
+                values = [None if is_null else val for val, is_null in zip(values, nulls.tolist())]
+            columns[name] = values
+        return columns
@@ -0,0 +1,81 @@
+import asyncio
+import os
+import sqlite3
+import sys
+import types
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database  # noqa: E402
+
+SCHEMA = """
+CREATE TABLE "CHARACTERS" (
+    "id" INTEGER NOT NULL UNIQUE, "username" TEXT NOT NULL, "password" TEXT NOT NULL,
+    "is_admin" INTEGER NOT NULL DEFAULT 0, "level" INTEGER NOT NULL DEFAULT 0, "charclass" TEXT NOT NULL,
+    "next_ttl" INTEGER NOT NULL DEFAULT 600, "nick" TEXT, "userhost" TEXT, "online" INTEGER NOT NULL DEFAULT 0,
+    "idled" INTEGER NOT NULL DEFAULT 0, "x_pos" INTEGER NOT NULL DEFAULT 0, "y_pos" INTEGER NOT NULL DEFAULT 0,
+    "pen_msg" INTEGER NOT NULL DEFAULT 0, "pen_nick" INTEGER NOT NULL DEFAULT 0,
+    "pen_part" INTEGER NOT NULL DEFAULT 0, "pen_kick" INTEGER NOT NULL DEFAULT 0,
+    "pen_quit" INTEGER NOT NULL DEFAULT 0, "pen_quest" INTEGER NOT NULL DEFAULT 0,
+    "pen_logout" INTEGER NOT NULL DEFAULT 0, "created" INTEGER NOT NULL DEFAULT 0,
+    "lastlogin" INTEGER NOT NULL DEFAULT 0, "amulet" TEXT NOT NULL DEFAULT '0', "charm" TEXT NOT NULL DEFAULT '0',
+    "helm" TEXT NOT NULL DEFAULT '0', "boots" TEXT NOT NULL DEFAULT '0', "gloves" TEXT NOT NULL DEFAULT '0',
+    "ring" TEXT NOT NULL DEFAULT '0', "legs" TEXT NOT NULL DEFAULT '0', "shield" TEXT NOT NULL DEFAULT '0',
+    "tunic" TEXT NOT NULL DEFAULT '0', "weapon" TEXT NOT NULL DEFAULT '0', "alignment" TEXT NOT NULL DEFAULT 'n',
+    "gold" INTEGER NOT NULL DEFAULT 0, "powerpots" INTEGER NOT NULL DEFAULT 0, "ffight" INTEGER NOT NULL DEFAULT 0,
+    "bwon" INTEGER NOT NULL DEFAULT 0, "blost" INTEGER NOT NULL DEFAULT 0, "badd" INTEGER NOT NULL DEFAULT 0,
+    "bminus" INTEGER NOT NULL DEFAULT 0, "avatar" TEXT NOT NULL DEFAULT 'not set',
+    "sex" TEXT NOT NULL DEFAULT 'not set', "age" TEXT NOT NULL DEFAULT 'not set',
+    "location" TEXT NOT NULL DEFAULT 'not set', "email" TEXT NOT NULL DEFAULT 'not set',
+    "regentm" INTEGER NOT NULL DEFAULT 0, "challengetime" INTEGER NOT NULL DEFAULT 0,
+    "hero" INTEGER NOT NULL DEFAULT 0, "hlevel" INTEGER NOT NULL DEFAULT 0, "slaytime" INTEGER NOT NULL DEFAULT 0,
+    "bet" INTEGER NOT NULL DEFAULT 0, "pot" INTEGER NOT NULL DEFAULT 0, "engineer" INTEGER NOT NULL DEFAULT 0,
+    "englevel" INTEGER NOT NULL DEFAULT 0, "network" TEXT DEFAULT NULL, "luckpots" INTEGER NOT NULL DEFAULT 0,
+    "bank" INTEGER NOT NULL DEFAULT 0, "luckload" INTEGER NOT NULL DEFAULT -1,
+    "powerload" INTEGER NOT NULL DEFAULT -1, "team" INTEGER DEFAULT NULL,
+    "rname" TEXT NOT NULL DEFAULT 'not set', PRIMARY KEY("id")
+)
+"""
+
+
+@pytest.fixture
+def db(tmp_path):
+    filename = str(tmp_path / 'irpg.db')
+    dbh = sqlite3.connect(filename)
+    dbh.execute(SCHEMA)
+    dbh.commit()
+    dbh.close()
+    db = database.Database(filename)
+    yield db
+    db.close()
+
+
+def discord_member(player_id, status='offline'):
+    return types.SimpleNamespace(
+        id=player_id, name=f"p{player_id}", global_name=None, status=status, raw_status=status,
+        guild=types.SimpleNamespace(name='G'),
+    )
+
+
+@pytest.fixture
+def member():
+    return discord_member
+
+
+@pytest.fixture
+def find():
+    def find(chars, player_id):
+        return asyncio.run(chars.find(discord_member(player_id)))
+    return find
+
+
+@pytest.fixture
+def settle():
+    def settle(chars):
+        # Write everything, wait for it, then let the characters know it's written
+        chars.flush()
+        chars.db.flush()
+        chars.flush()
+    return settle
@@ -0,0 +1,194 @@
+import asyncio
+
+import pytest
+
+import characters
+
+
+def test_evicted_character_keeps_its_values(db, find, settle):
+    chars = characters.Characters(db, resident=1)
+    chars.load()
+    held = find(chars, 1)
+    held.level = 9
+    held.next_ttl = 629
+    held.x_pos = 12
+    find(chars, 2)
+    find(chars, 3)
+    settle(chars)
+    assert 1 not in chars.chars
+    assert (held.level, held.next_ttl, held.x_pos) == (9, 629, 12)
+    # The freed row goes to someone else without touching the evicted character
+    find(chars, 4).level = 3
+    assert held.level == 9
+
+
+def test_cold_miss_on_the_loop_fills_in_later(db, find, settle):
+    chars = characters.Characters(db)
+    chars.load()
+    find(chars, 1).email = 'p1@example.com'
+    settle(chars)
+    chars.cold.entries.clear()
+
+    async def read():
+        values = chars.cold.get(1)
+        assert values == {}
+        await chars.cold.fetch_queued()
+        return values
+
+    assert asyncio.run(read())['email'] == 'p1@example.com'
+    assert chars.chars[1].email == 'p1@example.com'
+
+
+def test_database_ranking_matches_memory(db, find):
+    chars = characters.Characters(db)
+    chars.load()
+    for player_id, level in ((1, 4), (2, 9), (3, 1), (4, 9)):
+        find(chars, player_id).level = level
+    chars.flush()
+    resident = characters.Characters(db, resident=0)
+    resident.load()
+
+    async def compare():
+        for sort in ('top', 'level', 'user', 'created'):
+            assert await resident.ranking.ordered(sort) == await chars.ranking.ordered(sort)
+        assert await resident.ranking.rank(chars.chars[2]) == await chars.ranking.rank(chars.chars[2])
+
+    asyncio.run(compare())
+
+
+def test_evicted_character_comes_back_from_the_database(db, find, settle):
+    chars = characters.Characters(db, resident=1)
+    chars.load()
+    find(chars, 1).level = 7
+    find(chars, 2)
+    find(chars, 3)
+    settle(chars)
+    assert 1 not in chars.chars
+    back = find(chars, 1)
+    assert back.level == 7
+    assert chars.chars[1] is back
+
+
+def test_load_from_snapshot_marks_everyone_offline(db, member, find, tmp_path):
+    import snapshot
+    snap = snapshot.Snapshot(str(tmp_path / 'irpg.snapshot'))
+    chars = characters.Characters(db, snapshot=snap, resident=10)
+    chars.load()
+    asyncio.run(chars.find(member(1, 'online')))
+    asyncio.run(chars.checkpoint()).result()
+    again = characters.Characters(db, snapshot=snap, resident=10)
+    again.load()
+    assert again.chars[1].online == 0
+    assert db.query("select online from characters where id = 1").result()[1] == [(0,)]
+
+
+def test_coming_online_updates_lastlogin(db, find):
+    chars = characters.Characters(db)
+    chars.load()
+    char = find(chars, 1)
+    char.lastlogin = 1000
+    char.online = 1
+    assert char.lastlogin > 1000
+
+
+def test_checkpoint_reads_again_anyone_changed_meanwhile(db, member, find, tmp_path):
+    import snapshot
+    snap = snapshot.Snapshot(str(tmp_path / 'irpg.snapshot'))
+    chars = characters.Characters(db, snapshot=snap)
+    chars.load()
+    for player_id in (1, 2, 3):
+        find(chars, player_id)
+
+    async def meanwhile():
+        saving = asyncio.ensure_future(chars.checkpoint(chunk=1))
+        await asyncio.sleep(0)
+        chars.chars[1].gold = 50  # Already read
+        await chars.find(member(4))
+        return await asyncio.wrap_future(await saving)
+
+    asyncio.run(meanwhile())
+    again = characters.Characters(db, snapshot=snap)
+    again.load()
+    assert again.chars[1].gold == 50
+    assert 4 in again.chars
+
+
+def test_load_marks_everyone_offline_in_the_database(db):
+    db.submit([("insert into characters (id, username, password, charclass, online) values (?, ?, '', '', 1)",
+                [(1, 'p1')])])
+    chars = characters.Characters(db)
+    chars.load()
+    assert chars.chars[1].online == 0
+    assert db.query("select online from characters where id = 1").result()[1] == [(0,)]
+
+
+def test_failed_write_is_tried_again(db, member, find):
+    chars = characters.Characters(db)
+    chars.load()
+
+    async def run():
+        first = await chars.find(member(1))
+        second = await chars.find(member(2))
+        chars.flush()
+        await db.barrier()
+        first.gold = 50
+        second.bank = None  # Breaks the NOT NULL constraint, failing the whole batch
+        chars.flush()
+        await db.barrier()
+        await asyncio.sleep(0)
+        assert chars.dirty == {1, 2}
+        second.bank = 5
+        chars.flush()
+        await db.barrier()
+
+    asyncio.run(run())
+    assert db.query("select id, gold, bank from characters order by id").result()[1] == [(1, 50, 0), (2, 0, 5)]
+
+
+def test_hydrated_values_only_last_the_page(db, find, settle):
+    import coldcache
+    chars = characters.Characters(db, cold_cache=1)
+    chars.load()
+    for player_id in (1, 2, 3):
+        find(chars, player_id)
+    settle(chars)
+    chars.cold.entries.clear()
+
+    async def page():
+        lent = await chars.fetch([1, 2, 3])
+        async with chars.hydrated(lent):
+            assert [c.email for c in lent] == ['not set'] * 3
+        assert not chars.cold.lent and not chars.cold.entries
+        with pytest.raises(coldcache.ColdMiss):
+            lent[0].email
+
+    asyncio.run(page())
+
+
+def test_write_updates_only_the_changed_columns(db, find, settle, monkeypatch):
+    chars = characters.Characters(db)
+    chars.load()
+    for player_id in (1, 2, 3):
+        find(chars, player_id)
+    settle(chars)
+    db.submit([("update characters set bwon = 9", [()])]).result()
+    statements = []
+    submit = db.submit
+    monkeypatch.setattr(db, 'submit', lambda batch: statements.extend(batch) or submit(batch))
+    chars.chars[1].gold = 5
+    chars.chars[2].gold = 6
+    chars.chars[3].gold = 7
+    chars.chars[3].bank = 8
+    find(chars, 4).gold = 1
+    chars.flush()
+    db.flush()
+    queries = [query for query, rows in statements]
+    assert set(chars.update_queries) == {('gold',), ('bank', 'gold')}
+    assert queries.count(chars.update_queries[('gold',)]) == 1
+    assert queries.count(chars.update_queries[('bank', 'gold')]) == 1
+    assert sum(query.startswith('replace') for query in queries) == 1
+    rows = db.query("select id, gold, bank, bwon, charclass from characters order by id").result()[1]
+    assert rows == [
+        (1, 5, 0, 9, 'IdleRPG Player'), (2, 6, 0, 9, 'IdleRPG Player'),
+        (3, 7, 8, 9, 'IdleRPG Player'), (4, 1, 0, 0, 'IdleRPG Player'),
+    ]
@@ -0,0 +1,16 @@
+import charstore
+
+
+def test_requeued_rows_come_up_again_once():
+    store = charstore.CharStore()
+    store.clock = 1000
+    rows = [store.add(char_id) for char_id in (1, 2, 3)]
+    for row in rows:
+        store.set_online(row, 1)
+        store.set_next_ttl(row, 10)
+    assert sorted(store.tick(1010)) == rows
+    # The first was levelled up before something went wrong, the rest weren't
+    store.set_next_ttl(rows[0], 600)
+    store.requeue(rows)
+    assert sorted(store.tick(1011)) == rows[1:]
+    assert store.tick(1012) == []
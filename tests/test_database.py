@@ -0,0 +1,42 @@
+import asyncio
+import threading
+
+import database
+
+
+def test_loop_keeps_running_while_the_writer_is_stalled(tmp_path):
+    db = database.Database(str(tmp_path / 'irpg.db'), maxlen=2)
+    stalled = threading.Event()
+
+    async def run():
+        db.put(lambda dbh: stalled.wait())
+        for n in range(5):
+            db.submit([("pragma user_version", [()])])  # Never blocks on the loop
+        reading = asyncio.ensure_future(db.read("select 1"))
+        ticks = 0
+        while ticks < 10:
+            await asyncio.sleep(0)
+            ticks += 1
+        assert not reading.done()
+        stalled.set()
+        return await reading
+
+    assert asyncio.run(run()) == (['1'], [(1,)])
+    db.close()
+
+
+def test_writer_outlives_a_cancelled_wait(tmp_path):
+    db = database.Database(str(tmp_path / 'irpg.db'))
+    stalled = threading.Event()
+
+    async def run():
+        db.put(lambda dbh: stalled.wait())
+        reading = asyncio.ensure_future(db.read("select 1"))
+        await asyncio.sleep(0)
+        reading.cancel()
+        await asyncio.sleep(0)
+        stalled.set()
+        return await db.read("select 2")
+
+    assert asyncio.run(run()) == (['2'], [(2,)])
+    db.close()
@@ -0,0 +1,27 @@
+import asyncio
+
+import outbox
+
+
+class SlowChannel:
+    def __init__(self):
+        self.posted = []
+
+    async def send(self, text):
+        await asyncio.sleep(0.05)
+        self.posted.append(text)
+
+
+def test_drain_waits_for_the_post_in_flight():
+    async def run():
+        box = outbox.Outbox(min_interval=0)
+        channel = SlowChannel()
+        box.start(channel)
+        box.send('hello')
+        await asyncio.sleep(0.01)  # Popped from the queue, still being posted
+        assert not box.queue
+        await box.drain(timeout=1)
+        box.task.cancel()
+        return channel.posted
+
+    assert asyncio.run(run()) == ['hello']
@@ -0,0 +1,42 @@
+import asyncio
+import random
+
+import characters
+
+
+def test_array_indexes_follow_the_clock(db, find):
+    chars = characters.Characters(db)
+    chars.load()
+    rng = random.Random(1)
+    for player_id in range(1, 41):
+        char = find(chars, player_id)
+        char.level = rng.randint(0, 5)
+        char.next_ttl = rng.randint(0, 1000)
+        char.online = rng.randint(0, 1)
+    sorts = {
+        'top': lambda c: (-c.level, c.next_ttl, c.id),
+        'ttl': lambda c: (c.next_ttl, c.id),
+        'idled': lambda c: (c.idled, c.id),
+    }
+
+    async def check():
+        for sort, key in sorts.items():
+            expected = [c.id for c in sorted(chars.chars.values(), key=key)]
+            assert await chars.ranking.ordered(sort) == expected
+            assert await chars.ranking.ordered(sort, reverse=True, start=3, count=5) == expected[::-1][3:8]
+            for char in chars.chars.values():
+                assert await chars.ranking.rank(char, sort) == expected.index(char.id) + 1
+
+    for step in range(20):
+        asyncio.run(check())
+        chars.tick(chars.store.clock + rng.randint(1, 300))
+        for char in rng.sample(list(chars.chars.values()), 5):
+            change = rng.randint(0, 3)
+            if change == 0:
+                char.online = 1 - char.online
+            elif change == 1:
+                char.level += 1
+            elif change == 2:
+                char.next_ttl = rng.randint(0, 1000)
+            else:
+                char.idled = rng.randint(0, 1000)
@@ -0,0 +1,29 @@
+import registry
+
+
+def content(tmp_path, monsters, events='G found a coin\n'):
+    (tmp_path / 'monsters.txt').write_text(monsters)
+    (tmp_path / 'events.txt').write_text(events)
+    return registry.ContentRegistry(str(tmp_path / 'monsters.txt'), str(tmp_path / 'events.txt'))
+
+
+def test_monster_name_past_the_strongest_monster(tmp_path):
+    reg = content(tmp_path, '8 Rat\n2 Bat\n50 Dragon\n')
+    assert reg.monster_name(1) == 'Bat'
+    assert reg.monster_name(8) == 'Rat'
+    assert reg.monster_name(9) == 'Dragon'
+    assert reg.monster_name(10 ** 6) == 'Dragon'
+
+
+def test_broken_file_keeps_the_old_monsters_and_is_tried_again(tmp_path):
+    import os
+    reg = content(tmp_path, '2 Bat\n8 Rat\n')
+    path = tmp_path / 'monsters.txt'
+    path.write_text('2 Bat\nhalf')
+    os.utime(path, (1, 1))
+    reg.refresh()
+    assert reg.monster_sums == [2, 8]
+    path.write_text('2 Bat\n8 Rat\n50 Dragon\n')
+    os.utime(path, (1, 1))  # Same mtime as the broken one, so only a retry picks it up
+    reg.refresh()
+    assert reg.monster_names == ['Bat', 'Rat', 'Dragon']
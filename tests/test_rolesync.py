@@ -0,0 +1,66 @@
+import asyncio
+
+import rolesync
+
+
+class Member:
+    def __init__(self, member_id, status, roles=()):
+        self.id = member_id
+        self.raw_status = status
+        self.roles = list(roles)
+        self.calls = []
+
+    async def add_roles(self, role, reason=None):
+        await asyncio.sleep(0.01)
+        self.calls.append(('add', role))
+
+    async def remove_roles(self, *roles, reason=None):
+        await asyncio.sleep(0.01)
+        self.calls.append(('remove',) + roles)
+
+
+def sync():
+    roles = rolesync.RoleSync(workers=4)
+    roles.set_roles('Online', 'Idle', 'DND')
+    return roles
+
+
+def test_changes_only_makes_the_calls_needed():
+    roles = sync()
+    assert roles.changes(Member(1, 'online')) == ('Online', [])
+    assert roles.changes(Member(1, 'online', ['Online'])) == (None, [])
+    assert roles.changes(Member(1, 'idle', ['Online', 'Other'])) == ('Idle', ['Online'])
+    assert roles.changes(Member(1, 'offline', ['DND', 'Idle'])) == (None, ['Idle', 'DND'])
+
+
+def test_requests_for_a_waiting_member_are_merged():
+    async def run():
+        roles = sync()
+        first = Member(1, 'online')
+        latest = Member(1, 'idle')
+        roles.request(first)
+        roles.request(latest)
+        assert roles.merged == 1 and roles.queue.qsize() == 1
+        roles.start()
+        await asyncio.sleep(0.05)
+        return first.calls, latest.calls
+
+    assert asyncio.run(run()) == ([], [('add', 'Idle')])
+
+
+def test_member_in_flight_is_synced_again_afterwards_not_alongside():
+    async def run():
+        roles = sync()
+        roles.start()
+        first = Member(1, 'online')
+        roles.request(first)
+        await asyncio.sleep(0.005)  # Its call is in flight
+        latest = Member(1, 'dnd', ['Online'])
+        roles.request(latest)
+        assert roles.queue.qsize() == 0
+        await asyncio.sleep(0.005)
+        assert latest.calls == []
+        await asyncio.sleep(0.05)
+        return first.calls, latest.calls
+
+    assert asyncio.run(run()) == ([('add', 'Online')], [('remove', 'Online'), ('add', 'DND')])
@@ -0,0 +1,61 @@
+import asyncio
+import random
+
+import scheduler
+
+
+def events():
+    random.seed(1)
+    events = scheduler.EventScheduler()
+    events.add('hog', 'online', 10, 'hog')
+    events.add('godsend', 'good', 10, 'godsend')
+    return events
+
+
+def test_zero_population_disables_an_event():
+    sched = events()
+    sched.update({'online': 5}, 0)
+    assert sched.due['hog'] is not None and sched.due['godsend'] is None
+    sched.update({'online': 0}, 0)
+    assert sched.due['hog'] is None
+    assert sched.pop_due(1e9) == []
+
+
+def test_pop_due_fires_each_event_at_most_once_per_tick():
+    sched = events()
+    sched.update({'online': 1000, 'good': 1000}, 0)
+    # Both are due many times over by now, but each fires once a tick
+    for _ in range(3):
+        assert sorted(sched.pop_due(100)) == ['godsend', 'hog']
+    sched.update({'online': 0, 'good': 0}, 100)
+    assert sched.pop_due(100) == []
+
+
+def test_late_tick_skips_the_missed_periods(monkeypatch):
+    clock = [0.0]
+
+    async def tick():
+        if ticks.ticks == 0:
+            clock[0] += 0.35  # Overruns into the third period after its deadline
+        else:
+            ticks.stop()
+
+    ticks = scheduler.TickScheduler(0.1, tick)
+    monkeypatch.setattr(scheduler.time, 'monotonic', lambda: clock[0])
+    asyncio.run(asyncio.wait_for(ticks.run(), 1))
+    assert ticks.ticks == 2 and ticks.skipped == 2 and ticks.overruns == 1
+    # The second tick aims at the deadline after the skipped ones, not the missed one
+    assert abs(ticks.last_lag - 0.05) < 1e-9
+
+
+def test_stop_wakes_the_wait():
+    async def run():
+        ticks = scheduler.TickScheduler(60, tick=lambda: asyncio.sleep(0))
+        task = asyncio.create_task(ticks.run())
+        await asyncio.sleep(0.01)
+        assert ticks.ticks == 1
+        ticks.stop()
+        await asyncio.wait_for(task, 1)
+        return ticks.ticks
+
+    assert asyncio.run(run()) == 1